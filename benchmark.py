@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+#coding=utf-8
+
+########################################################################
+# Замер производительности dbSync.py без Oracle
+# Синтетические таблицы создаются в SQLite, через SQLAlchemy
+########################################################################
+
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import logging
+from datetime import datetime
+import sqlalchemy as sa
+
+import dbSync
+
+#Генерация строк: ключ ID с заданной кардинальностью и столбцы C1..Cn попеременно строками и числами
+def generate_rows(rows, width, cardinality, seed):
+	rnd = random.Random(seed)
+	for i in range(rows):
+		row = {'ID' : i % cardinality}
+		for column in range(1, width):
+			if column % 2:
+				row[f'C{column}'] = ''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz') for j in range(12))
+			else:
+				row[f'C{column}'] = rnd.randint(0, 10**9)
+		yield row
+
+#Удаленная таблица R и локальная L, в которой нет доли diff_ratio строк удаленной
+def create_tables(engine, conf):
+	columns = ['ID'] + [f'C{column}' for column in range(1, conf['width'])]
+	rnd = random.Random(conf['seed'])
+	with engine.begin() as conn:
+		for table in ('R', 'L', 'T'):
+			conn.execute(sa.text(f"DROP TABLE IF EXISTS {table}"))
+			conn.execute(sa.text(f"CREATE TABLE {table} ({','.join(columns)})"))
+		query = f"INSERT INTO {{}} ({','.join(columns)}) VALUES ({','.join(':'+column for column in columns)})"
+		for batch in dbSync.batched(generate_rows(conf['rows'], conf['width'], conf['cardinality'], conf['seed']), 10000):
+			conn.execute(sa.text(query.format('R')), batch)
+			conn.execute(sa.text(query.format('L')), [row for row in batch if rnd.random() >= conf['diff_ratio']])
+	return columns
+
+def table_conf(engine, name):
+	return {'engine' : engine, 'prefix' : '', 'postfix' : '', 'name' : name, 'filter' : ''}
+
+#Фазы замера: каждая возвращает кол-во обработанных строк
+def phase_fetch(engine, columns, conf):
+	rows = 0
+	for row in dbSync.get_big_table_data(engine, columns, 'R'):
+		rows += 1
+	return rows
+
+def phase_diff(engine, columns, conf, diff_conf):
+	remote = table_conf(engine, 'R')
+	local = table_conf(engine, 'L')
+	remote['data'] = dbSync.get_big_table_data(engine, columns, 'R')
+	local['data'] = dbSync.get_big_table_data(engine, columns, 'L')
+	columns_conf = {'local_columns' : columns, 'remote_columns' : columns, 'map_columns' : {}, 'diff_key' : ['ID']}
+	#Скорость считаем по прочитанным строкам, найденные отличия только выбираем до конца
+	for row in dbSync.compare_tables(remote, local, columns_conf, False, diff_conf):
+		pass
+	return conf['rows']
+
+def phase_insert(engine, columns, conf):
+	with engine.begin() as conn:
+		conn.execute(sa.text("DELETE FROM T"))
+	if dbSync.insert_table_data(engine, columns, 'T', dbSync.get_big_table_data(engine, columns, 'R'),
+								{'array_size' : conf['array_size']}) == None:
+		raise BaseException('Insert failed')
+	return conf['rows']
+
+def phase_backup(engine, columns, conf):
+	with tempfile.TemporaryDirectory() as path:
+		filename = dbSync.make_csv(dbSync.get_big_table_data(engine, columns, 'L'), 'L',
+									{'backup_path' : path}, {'compress' : conf['compress']})
+		if filename == None:
+			raise BaseException('Backup failed')
+	return conf['rows']
+
+PHASES = {'fetch' : phase_fetch,
+		'diff_set' : lambda engine, columns, conf: phase_diff(engine, columns, conf, {'method' : 'set'}),
+		'diff_hash' : lambda engine, columns, conf: phase_diff(engine, columns, conf, {'method' : 'set', 'key_index' : 'hash'}),
+		'diff_merge' : lambda engine, columns, conf: phase_diff(engine, columns, conf, {'method' : 'merge'}),
+		'insert' : phase_insert,
+		'backup' : phase_backup}
+
+#Скорость берем по лучшему из повторов, память - отдельным прогоном под tracemalloc (он замедляет выполнение)
+def run_phase(name, engine, columns, conf):
+	timings = []
+	for i in range(conf['repeat']):
+		started = time.perf_counter()
+		rows = PHASES[name](engine, columns, conf)
+		timings.append(time.perf_counter() - started)
+	tracemalloc.start()
+	PHASES[name](engine, columns, conf)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	best = min(timings)
+	return {'rows' : rows,
+			'seconds' : round(best, 4),
+			'rows_per_sec' : round(rows / best, 1) if best > 0 else None,
+			'peak_mb' : round(peak / 1024 / 1024, 2)}
+
+#Сравнение с базовым прогоном: падение скорости больше порога считается регрессией
+def compare_baseline(results, baseline, threshold):
+	regressions = []
+	if baseline['params'] != results['params']:
+		logging.warning('The baseline was made with other parameters: '+json.dumps(baseline['params']))
+	for name, phase in results['phases'].items():
+		if (name not in baseline['phases']) or (baseline['phases'][name]['rows_per_sec'] == None) or (phase['rows_per_sec'] == None):
+			continue
+		change = phase['rows_per_sec'] / baseline['phases'][name]['rows_per_sec'] - 1
+		logging.info(f'{name}: {baseline["phases"][name]["rows_per_sec"]} -> {phase["rows_per_sec"]} rows/sec ({change:+.1%})')
+		if change < -threshold:
+			regressions.append(name)
+	return regressions
+
+if __name__ == '__main__':
+
+	cmd_parser = argparse.ArgumentParser(description='dbSync.py benchmark on a local SQLite database')
+	cmd_parser.add_argument('--rows', type=int, default=100000, help='rows in the remote table')
+	cmd_parser.add_argument('--width', type=int, default=8, help='columns in the table, including the key')
+	cmd_parser.add_argument('--cardinality', type=int, help='distinct key values, default is the number of rows')
+	cmd_parser.add_argument('--diff-ratio', dest='diff_ratio', type=float, default=0.1, help='share of remote rows missing in the local table')
+	cmd_parser.add_argument('--array-size', dest='array_size', type=int, default=5000, help='insert batch size')
+	cmd_parser.add_argument('--compress', default='none', choices=['none', 'gzip', 'zstd'], help='backup compression')
+	cmd_parser.add_argument('--repeat', type=int, default=3, help='timed runs of each phase, the best one is reported')
+	cmd_parser.add_argument('--seed', type=int, default=1)
+	cmd_parser.add_argument('--phases', default=','.join(PHASES), help='comma separated list of phases')
+	cmd_parser.add_argument('--db', help='SQLite file, a temporary one by default')
+	cmd_parser.add_argument('--output', help='save the results to this JSON file')
+	cmd_parser.add_argument('--baseline', help='compare with the results saved earlier')
+	cmd_parser.add_argument('--threshold', type=float, default=0.1, help='allowed throughput drop against the baseline')
+	cmd_args = cmd_parser.parse_args()
+
+	logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+	conf = {'rows' : cmd_args.rows,
+			'width' : max(cmd_args.width, 1),
+			'cardinality' : cmd_args.cardinality or cmd_args.rows,
+			'diff_ratio' : cmd_args.diff_ratio,
+			'array_size' : cmd_args.array_size,
+			'compress' : cmd_args.compress,
+			'repeat' : max(cmd_args.repeat, 1),
+			'seed' : cmd_args.seed}
+
+	with tempfile.TemporaryDirectory() as tmp_path:
+		engine = sa.create_engine('sqlite:///'+(cmd_args.db or os.path.join(tmp_path, 'benchmark.db')))
+		logging.info(f'Generating {conf["rows"]} rows...')
+		columns = create_tables(engine, conf)
+		results = {'time' : datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+					'python' : sys.version.split()[0],
+					'sqlalchemy' : sa.__version__,
+					'params' : {key : value for key, value in conf.items() if key != 'repeat'},
+					'phases' : {}}
+		for name in cmd_args.phases.split(','):
+			if name not in PHASES:
+				cmd_parser.error('unknown phase '+name)
+			results['phases'][name] = run_phase(name, engine, columns, conf)
+			logging.info(f'{name}: {results["phases"][name]["rows_per_sec"]} rows/sec, peak {results["phases"][name]["peak_mb"]} MB')
+		engine.dispose()
+
+	if cmd_args.output != None:
+		with open(cmd_args.output, 'w', encoding='utf-8') as f:
+			json.dump(results, f, indent=1)
+
+	if cmd_args.baseline != None:
+		with open(cmd_args.baseline, encoding='utf-8') as f:
+			regressions = compare_baseline(results, json.load(f), cmd_args.threshold)
+		if regressions:
+			logging.error('Throughput regressions: '+', '.join(regressions))
+			sys.exit(1)
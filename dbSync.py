@@ -14,15 +14,59 @@ from yaml.loader import SafeLoader
 import sqlalchemy as sa
 import oracledb
 import csv
+import gzip
 import os
 from datetime import datetime, timedelta
 from decimal import Decimal
 from collections import namedtuple
+from operator import attrgetter
 import logging
+import json
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+try:
+	import resource
+except ImportError:
+	resource = None
+try:
+	import numpy
+except ImportError:
+	numpy = None
+import threading
+import time
+import queue
+import sys
+import re
+import io
+import tempfile
+import hashlib
+from array import array
+from bisect import bisect_left
+import multiprocessing
+import signal
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
-#Раскрываем настройки для коннекта
+#Контекст потока, в котором синхронизируется таблица
+sync_context = threading.local()
+#Файл состояния общий для всех потоков
+state_lock = threading.Lock()
+#Движки БД общие для всех заданий и таблиц: по одному на DSN, каждый со своим пулом сессий oracledb
+engines = {}
+engines_lock = threading.Lock()
+#Метрики таблицы пополняются и из вспомогательных потоков
+metrics_lock = threading.Lock()
+#Последние метрики каждой таблицы для Prometheus: демон синхронизирует задания по отдельности
+prometheus_tables = {}
+#Типы LOB и размер части, которой переливаются большие значения
+lob_types = {'CLOB' : oracledb.DB_TYPE_CLOB, 'NCLOB' : oracledb.DB_TYPE_NCLOB, 'BLOB' : oracledb.DB_TYPE_BLOB}
+lob_piece_size = 1048576
+
+#Раскрываем настройки для коннекта в копии конфига задания (демон использует исходный при каждом запуске)
 def replace_connects(sync_conf, conn_config):
 
+	sync_conf = dict(sync_conf)
 	portable_attrs = ['scheme_name', 'postfix', 'db_user', 'db_password', 'db_host', 'db_port', 'db_name']
 	
 	for db in ['local_db', 'remote_db']:
@@ -46,51 +90,294 @@ def replace_connects(sync_conf, conn_config):
 			sync_conf[db]['postfix'] = '@'+sync_conf[db]['postfix']
 	return(sync_conf)
 	
-#Установка соединения с БД
-def get_db_connection(conn_conf, get_dsn=False):
+#Метрики синхронизации таблицы: время фаз, строки, пачки и обращения к БД
+def new_metrics(sync, table):
+	return {'time' : datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+			'job' : sync,
+			'table' : table,
+			'result' : None,
+			'duration' : 0.0,
+			'phases' : {},
+			'rows_read' : 0,
+			'rows_written' : 0,
+			'rows_skipped' : 0,
+			'batches' : 0,
+			'round_trips' : 0,
+			'rows_rejected' : 0,
+			'lobs_streamed' : 0,
+			'unchanged' : 0,
+			'peak_rss_kb' : 0}
+
+#Счетчик метрик текущей таблицы, вне синхронизации таблицы ничего не делает
+def add_metric(name, value=1):
+	metrics = getattr(sync_context, 'metrics', None)
+	if metrics != None:
+		with metrics_lock:
+			metrics[name] += value
+
+#Время фазы от момента started, фазы из нескольких потоков суммируются
+def add_phase_time(phase, started):
+	metrics = getattr(sync_context, 'metrics', None)
+	if metrics != None:
+		with metrics_lock:
+			metrics['phases'][phase] = metrics['phases'].get(phase, 0.0) + time.monotonic() - started
+
+#Пиковое потребление памяти процессом
+def peak_rss_kb():
+	if resource == None:
+		return 0
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+#Одинаковые настройки сессии на всех БД: порядок сортировки не должен зависеть от NLS
+#Форматы дат и чисел не меняем - приведение к строке для хэшей задано явно в самих выражениях (hash_text_expr)
+#Вызывается пулом только для новых сессий, повторно выданные из пула уже настроены
+def set_session_nls(connection, requested_tag):
+	cursor = connection.cursor()
+	cursor.execute("ALTER SESSION SET NLS_SORT=BINARY NLS_COMP=BINARY")
+	cursor.close()
+
+#Параметры пула сессий и выборки
+def get_pool_conf(general_config):
+	return {'pool_min' : int(general_config.get('pool_min', 1)),
+			'pool_size' : int(general_config.get('pool_size', 4)),
+			'stmt_cache_size' : int(general_config.get('stmt_cache_size', 50)),
+			'arraysize' : int(general_config.get('fetch_arraysize', 1000)),
+			'prefetchrows' : int(general_config.get('prefetch_rows', 1000))}
+
+#Установка соединения с БД: движок создается один раз на DSN, повторные вызовы возвращают его же
+def get_db_connection(conn_conf, pool_conf=None):
 	
 	required_attrs = ['db_user', 'db_password', 'db_host', 'db_name', 'db_port']
+	if pool_conf == None:
+		pool_conf = get_pool_conf({})
 	
 	try:
 		for attr in required_attrs:
 			if (attr not in conn_conf) or (conn_conf[attr] == ''):
 				raise BaseException('The required attribute '+attr+' could not be found')
-		dsn = f"oracle+oracledb://{conn_conf['db_user']}:{conn_conf['db_password']}@{conn_conf['db_host']}/?service_name={conn_conf['db_name']}"
-		if get_dsn:
-			return dsn
-		engine = sa.create_engine(dsn)
-		return engine
+		dsn = f"{conn_conf['db_host']}/{conn_conf['db_name']}"
+		with engines_lock:
+			#Пароль в ключе: после перечитывания конфига с новым паролем создастся новый пул
+			key = (conn_conf['db_user'], str(conn_conf['db_password']), dsn)
+			if key not in engines:
+				oracledb.defaults.prefetchrows = pool_conf['prefetchrows']
+				#Сессии сверх pool_size создаются по требованию (их число ограничивает max_sessions) и закрываются при возврате
+				pool = oracledb.create_pool(user=conn_conf['db_user'],
+											password=str(conn_conf['db_password']),
+											dsn=dsn,
+											min=min(pool_conf['pool_min'], pool_conf['pool_size']),
+											max=pool_conf['pool_size'],
+											increment=1,
+											getmode=oracledb.POOL_GETMODE_FORCEGET,
+											stmtcachesize=pool_conf['stmt_cache_size'],
+											session_callback=set_session_nls)
+				#Пулом управляет oracledb, SQLAlchemy только берет из него сессии
+				engines[key] = sa.create_engine('oracle+oracledb://',
+												creator=pool.acquire,
+												poolclass=sa.pool.NullPool,
+												arraysize=pool_conf['arraysize'])
+			return engines[key]
 	except BaseException as e:
 		logging.error(str(e))
 		return None
 		
+#LOB-столбцы словаря под именами, с которыми они приходят в выборке; столбцы ключа сравнения всегда читаются целиком
+def get_lob_conf(dictionary, map_columns, inline_size, key_columns):
+	names = {remote: local for local, remote in map_columns.items()}
+	columns = {names.get(row['COLUMN_NAME'], row['COLUMN_NAME']) for row in dictionary if row['DATA_TYPE'] in lob_types} - set(key_columns)
+	if not columns:
+		return None
+	return {'columns' : columns, 'inline_size' : int(inline_size)}
+
+#Выборка LOB: значения до inline_size приходят сразу строкой или байтами, большие - локатором в дополнительном столбце LOB$n
+def lob_select(columns, lob_conf):
+	select = []
+	extra = []
+	positions = []
+	for i, column in enumerate(columns):
+		expr, _, alias = column.partition(' AS ')
+		if (alias or expr).upper() in lob_conf['columns']:
+			large = f"DBMS_LOB.GETLENGTH({expr}) > {lob_conf['inline_size']}"
+			select.append(f"CASE WHEN {large} THEN NULL ELSE {expr} END AS {alias or expr}")
+			extra.append(f"CASE WHEN {large} THEN {expr} END AS LOB${len(extra) + 1}")
+			positions.append(i)
+		else:
+			select.append(column)
+	return select + extra, positions
+
+#Обработчик типов выборки: столбцы LOB$n остаются локаторами, остальные SQLAlchemy преобразует как обычно
+def lob_output_handler(handler):
+	def output_type_handler(cursor, name, default_type, size, precision, scale):
+		if name.startswith('LOB$'):
+			return None
+		if handler != None:
+			return handler(cursor, name, default_type, size, precision, scale)
+	return output_type_handler
+
+#Длина части в единицах смещения LOB: байты для BLOB, символы UTF-16 для CLOB
+def lob_length(piece):
+	if isinstance(piece, bytes):
+		return len(piece)
+	return len(piece.encode('utf-16-le')) // 2
+
+#Большой LOB переливается частями во временный файл (до inline_size - в памяти), пока открыта сессия
+def spool_lob(lob, inline_size):
+	if lob.type is oracledb.DB_TYPE_BLOB:
+		spool = tempfile.SpooledTemporaryFile(max_size=inline_size, mode='w+b')
+	else:
+		spool = tempfile.SpooledTemporaryFile(max_size=inline_size, mode='w+', encoding='utf-8', newline='')
+	amount = lob.getchunksize() * max(1, lob_piece_size // lob.getchunksize())
+	size = lob.size()
+	offset = 1
+	while offset <= size:
+		piece = lob.read(offset, amount)
+		if not piece:
+			break
+		spool.write(piece)
+		offset += lob_length(piece)
+		add_metric('round_trips')
+	add_metric('lobs_streamed')
+	return spool
+
+#Части большого LOB из временного файла
+def lob_pieces(spool):
+	spool.seek(0)
+	while True:
+		piece = spool.read(lob_piece_size)
+		if not piece:
+			return
+		yield piece
+
 #Запрос select к БД для большой таблицы
-def get_big_table_data(engine, columns, table, where=''):
+def get_big_table_data(engine, columns, table, where='', sizer=None, lob_conf=None):
+	lob_positions = []
+	if lob_conf != None:
+		columns, lob_positions = lob_select(columns, lob_conf)
+	width = len(columns) - len(lob_positions)
 	try:
 		logging.debug(f"SELECT {','.join(columns)} FROM {table} {where}")
 		with engine.connect() as conn:
+			if lob_positions:
+				dbapi_conn = conn.connection.dbapi_connection
+				dbapi_conn.outputtypehandler = lob_output_handler(dbapi_conn.outputtypehandler)
+			started = time.monotonic()
 			result = conn.execution_options(stream_results=True).execute(sa.text(f"SELECT {','.join(columns)} FROM {table} {where}"))
-			col_names = [col.upper() for col in result.keys()]
+			col_names = [col.upper() for col in result.keys()][:width]
 			Row = namedtuple('Row', col_names)
 			
 			while True:
-				rows = result.fetchmany(5000)
+				size = sizer['size'] if sizer != None else 5000
+				rows = result.fetchmany(size)
+				add_phase_time('fetch', started)
+				add_metric('round_trips')
 				if not rows:
 					break
+				add_metric('rows_read', len(rows))
+				if lob_positions:
+					rows = [spool_row_lobs(row, width, lob_positions, lob_conf['inline_size']) for row in rows]
+				if (sizer != None) and (len(rows) == size):
+					adjust_batch_size(sizer, rows, time.monotonic() - started)
 					
 				for row in rows:
 					yield Row(*row)
+				started = time.monotonic()
 					
+	#Генератор закрыли, не дочитав (например, слияние закончилось раньше)
+	except GeneratorExit:
+		raise
 	except BaseException as e:
 		logging.error('Error executing request:')
 		logging.error(f"SELECT {','.join(columns)} FROM {table} {where}")
 		logging.error(str(e))
-		return None
+		#Недочитанный поток нельзя принимать за конец таблицы, иначе сравнение/вставка отработают по части данных
+		raise
+
+#Большие LOB строки заменяются временными файлами, дополнительные столбцы LOB$n отбрасываются
+def spool_row_lobs(row, width, lob_positions, inline_size):
+	values = list(row[:width])
+	for i, position in enumerate(lob_positions):
+		if row[width + i] != None:
+			values[position] = spool_lob(row[width + i], inline_size)
+	return values
+
+#Выгрузка таблицы по частям: каждая часть читается в своей сессии параллельно, строки сливаются в один поток
+#Порядок строк не сохраняется
+def get_split_table_data(engine, columns, table, where, conditions, sizer=None, lob_conf=None):
+	batches = queue.Queue(maxsize=len(conditions) * 2)
+	abort = threading.Event()
+	errors = []
+	
+	#Ждем места в очереди, пока потребитель не закрыл поток и никто не упал
+	def put(item):
+		while not abort.is_set():
+			try:
+				batches.put(item, timeout=0.5)
+				return True
+			except queue.Full:
+				pass
+		return False
+	
+	#Читатель берет части из общей очереди, пока они не кончатся
+	pending = queue.Queue()
+	for condition in conditions:
+		pending.put(condition)
+	
+	def reader(semaphores):
+		try:
+			while not abort.is_set():
+				try:
+					condition = pending.get_nowait()
+				except queue.Empty:
+					break
+				rows = get_big_table_data(engine, columns, table, f"{where} AND ({condition})" if where != '' else f"WHERE {condition}", sizer, lob_conf)
+				try:
+					for batch in batched(rows, 5000, sizer):
+						if not put(batch):
+							break
+				finally:
+					rows.close()
+			put(None)
+		except BaseException as e:
+			errors.append(e)
+			abort.set()
+		finally:
+			release_session(semaphores)
+	
+	#Первый читатель работает в сессии таблицы, остальным нужны свободные места в max_sessions
+	threads = [context_thread(reader, [])]
+	for i in range(1, len(conditions)):
+		semaphores = try_acquire_session('remote')
+		if semaphores == None:
+			logging.info(f' max_sessions leaves {len(threads)} of {len(conditions)} sessions for the parallel extraction of {table}')
+			break
+		threads.append(context_thread(reader, semaphores))
+	for thread in threads:
+		thread.start()
+	finished = 0
+	try:
+		while (finished < len(threads)) and not abort.is_set():
+			try:
+				batch = batches.get(timeout=0.5)
+			except queue.Empty:
+				continue
+			if batch == None:
+				finished += 1
+				continue
+			for row in batch:
+				yield row
+	finally:
+		#Останавливаем читателей и в случае ошибки, и если поток закрыли, не дочитав
+		abort.set()
+		for thread in threads:
+			thread.join()
+	if errors:
+		raise errors[0]
 		
 #Запрос select к БД
 def get_table_data(engine, columns, table, where=''):
 	try:
 		logging.debug(f"SELECT {','.join(columns)} FROM {table} {where}")
+		add_metric('round_trips')
 		with engine.connect() as conn:
 			result = conn.execute(sa.text(f"SELECT {','.join(columns)} FROM {table} {where}"))
 			data = [
@@ -116,6 +403,7 @@ def get_table_data(engine, columns, table, where=''):
 def exec_query(engine, query):
 	try:
 		logging.debug(query)
+		add_metric('round_trips')
 		with engine.connect() as conn:
 			result = conn.execute(sa.text(query))
 			conn.commit()
@@ -127,32 +415,395 @@ def exec_query(engine, query):
 		result = None	
 	return result
 
-#Вставка данных в таблицу	
-def insert_table_data(engine, columns, table, insert_data):
+#Выполнение нескольких запросов в одной транзакции
+def exec_transaction(engine, queries):
 	try:
-		query = f"INSERT INTO {table} ({','.join(columns)}) VALUES ({','.join(f':{column}' for column in columns)})"
-		logging.debug(query)
-		batch = []
 		with engine.begin() as conn:
-			for row in insert_data:
-				batch.append({column: getattr(row,column) for column in columns})
-				if len(batch) >= 5000:
-					conn.execute(sa.text(query), batch)
-					batch.clear()
-					
-			if batch:
-				conn.execute(sa.text(query), batch)
+			for query in queries:
+				logging.debug(query)
+				add_metric('round_trips')
+				conn.execute(sa.text(query))
 		return True
 	except BaseException as e:
 		logging.error('Error executing request:')
-		logging.error(f"INSERT INTO {table} ({','.join(columns)}) VALUES ({','.join(f':{column}' for column in columns)})")
+		logging.error(query)
 		logging.error(str(e))
 		return None
+
+#Разбиение потока строк на пачки
+def batched(rows, size, sizer=None):
+	batch = []
+	for row in rows:
+		batch.append(row)
+		#Размер пачки может меняться по ходу выгрузки
+		if len(batch) >= (sizer['size'] if sizer != None else size):
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
+#Оценка памяти под строку в python по all_tab_columns: строки считаем по объявленной длине
+def estimate_row_bytes(columns, column_types):
+	row_bytes = 56 + 8 * len(columns)
+	for column in columns:
+		col = column_types.get(column)
+		if col == None:
+			row_bytes += 64
+		elif col['DATA_TYPE'] in ('VARCHAR2', 'CHAR', 'NVARCHAR2', 'NCHAR', 'RAW'):
+			row_bytes += 49 + int(col['DATA_LENGTH'] or 0)
+		elif col['DATA_TYPE'] in ('CLOB', 'NCLOB', 'BLOB', 'LONG', 'LONG RAW'):
+			row_bytes += 4096
+		else:
+			row_bytes += 64
+	return row_bytes
+
+#Подбор размера пачки под бюджет памяти: in_flight - сколько пачек может одновременно находиться в памяти
+def new_batch_sizer(memory_budget, columns, column_types, in_flight, size):
+	sizer = {'budget' : float(memory_budget) * 1024 * 1024,
+			'in_flight' : in_flight,
+			'row_bytes' : estimate_row_bytes(columns, column_types),
+			'min' : 100,
+			'max' : 100000,
+			#Пачка должна идти не меньше этого времени, иначе упираемся в задержку сети
+			'target' : 0.5}
+	sizer['size'] = max(sizer['min'], min(size, batch_size_cap(sizer)))
+	return sizer
+
+def batch_size_cap(sizer):
+	return min(sizer['max'], int(sizer['budget'] / sizer['in_flight'] / sizer['row_bytes']))
+
+#Подстройка размера пачки по фактическому размеру строк и времени обработки пачки
+def adjust_batch_size(sizer, rows, elapsed):
+	sample = rows[::max(1, len(rows) // 10)]
+	sizer['row_bytes'] = max(sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row) for row in sample)
+	size = sizer['size']
+	if elapsed > 0:
+		size = min(max(int(len(rows) * sizer['target'] / elapsed), size // 2), size * 2)
+	sizer['size'] = max(sizer['min'], min(size, batch_size_cap(sizer)))
+
+#Тип бинда для столбца по all_tab_columns, чтобы драйвер не угадывал его по первой пачке
+def input_size(column):
+	if column == None:
+		return None
+	data_type = column['DATA_TYPE']
+	if data_type in ('VARCHAR2', 'CHAR', 'NVARCHAR2', 'NCHAR', 'RAW'):
+		return int(column['DATA_LENGTH']) if column['DATA_LENGTH'] != None else None
+	if data_type in ('NUMBER', 'FLOAT'):
+		return oracledb.DB_TYPE_NUMBER
+	if data_type == 'DATE':
+		return oracledb.DB_TYPE_DATE
+	if data_type.startswith('TIMESTAMP'):
+		if data_type.endswith('LOCAL TIME ZONE'):
+			return oracledb.DB_TYPE_TIMESTAMP_LTZ
+		if data_type.endswith('TIME ZONE'):
+			return oracledb.DB_TYPE_TIMESTAMP_TZ
+		return oracledb.DB_TYPE_TIMESTAMP
+	if data_type == 'BINARY_DOUBLE':
+		return oracledb.DB_TYPE_BINARY_DOUBLE
+	if data_type == 'BINARY_FLOAT':
+		return oracledb.DB_TYPE_BINARY_FLOAT
+	if data_type == 'CLOB':
+		return oracledb.DB_TYPE_CLOB
+	if data_type == 'NCLOB':
+		return oracledb.DB_TYPE_NCLOB
+	if data_type == 'BLOB':
+		return oracledb.DB_TYPE_BLOB
+	return None
+
+#Открытие загрузчика: соединение с открытой транзакцией и запрос вставки
+#bulk_load - вставка через курсор oracledb кортежами, минуя обработку параметров SQLAlchemy
+def open_loader(engine, columns, table, load_conf=None):
+	load_conf = load_conf or {}
+	#Построчные ошибки (batcherrors) есть только у курсора oracledb, прямая вставка с ними не используется
+	loader = {'columns' : columns,
+			'native' : load_conf.get('bulk_load', False) or (load_conf.get('reject') != None),
+			'append_values' : load_conf.get('bulk_load', False) and load_conf.get('append_values', False) and (load_conf.get('reject') == None),
+			'reject' : load_conf.get('reject'),
+			'array_size' : int(load_conf.get('array_size', 5000)),
+			'sizer' : load_conf.get('sizer'),
+			'rows' : 0}
+	#Позиции и типы LOB-столбцов: большие значения приходят временными файлами
+	column_types = load_conf.get('column_types', {})
+	loader['lobs'] = [(i, column, lob_types[column_types[column]['DATA_TYPE']]) for i, column in enumerate(columns)
+						if (column in column_types) and (column_types[column]['DATA_TYPE'] in lob_types)]
+	if loader['native']:
+		hint = '/*+ APPEND_VALUES */ ' if loader['append_values'] else ''
+		loader['query'] = f"INSERT {hint}INTO {table} ({','.join(columns)}) VALUES ({','.join(f':{i + 1}' for i in range(len(columns)))})"
+		loader['input_sizes'] = [input_size(column_types.get(column)) for column in columns]
+		loader['getter'] = attrgetter(*columns)
+		loader['conn'] = engine.raw_connection()
+		loader['cursor'] = loader['conn'].cursor()
+		loader['dbapi_conn'] = loader['conn']
+	else:
+		loader['query'] = f"INSERT INTO {table} ({','.join(columns)}) VALUES ({','.join(f':{column}' for column in columns)})"
+		loader['conn'] = engine.connect()
+		loader['transaction'] = loader['conn'].begin()
+		loader['dbapi_conn'] = loader['conn'].connection.dbapi_connection
+	return loader
+
+#Значение для вставки: большой LOB копируется частями во временный LOB принимающей БД
+def lob_bind_value(connection, value, lob_type):
+	if not isinstance(value, tempfile.SpooledTemporaryFile):
+		return value
+	lob = connection.createlob(lob_type)
+	offset = 1
+	for piece in lob_pieces(value):
+		lob.write(piece, offset)
+		offset += lob_length(piece)
+		add_metric('round_trips')
+	return lob
+
+#Вставка пачки строк
+def load_batch(loader, rows):
+	started = time.monotonic()
+	if loader['native']:
+		if len(loader['columns']) == 1:
+			data = [(loader['getter'](row),) for row in rows]
+		else:
+			data = [loader['getter'](row) for row in rows]
+		if loader['lobs']:
+			data = [list(values) for values in data]
+			for values in data:
+				for i, column, lob_type in loader['lobs']:
+					values[i] = lob_bind_value(loader['dbapi_conn'], values[i], lob_type)
+		if any(size != None for size in loader['input_sizes']):
+			loader['cursor'].setinputsizes(*loader['input_sizes'])
+		if loader['reject'] != None:
+			loader['cursor'].executemany(loader['query'], data, batcherrors=True)
+			batch_errors = loader['cursor'].getbatcherrors()
+			if batch_errors:
+				reject_rows(loader['reject'], loader['columns'], data, batch_errors)
+				loader['rows'] -= len(batch_errors)
+				add_metric('rows_written', -len(batch_errors))
+		else:
+			loader['cursor'].executemany(loader['query'], data)
+		#После direct-path вставки таблицу нельзя менять в той же транзакции
+		if loader['append_values']:
+			loader['conn'].commit()
+			add_metric('round_trips')
+	else:
+		data = [{column: getattr(row, column) for column in loader['columns']} for row in rows]
+		for values in data:
+			for i, column, lob_type in loader['lobs']:
+				values[column] = lob_bind_value(loader['dbapi_conn'], values[column], lob_type)
+		loader['conn'].execute(sa.text(loader['query']), data)
+	loader['rows'] += len(rows)
+	if (loader['sizer'] != None) and (len(rows) == loader['sizer']['size']):
+		adjust_batch_size(loader['sizer'], rows, time.monotonic() - started)
+	add_phase_time('insert', started)
+	add_metric('round_trips')
+	add_metric('batches')
+	add_metric('rows_written', len(rows))
+
+#Завершение загрузки: коммит или откат и возврат соединения
+def close_loader(loader, commit):
+	try:
+		if loader['native']:
+			if commit:
+				loader['conn'].commit()
+			else:
+				loader['conn'].rollback()
+			loader['cursor'].close()
+		elif commit:
+			loader['transaction'].commit()
+		else:
+			loader['transaction'].rollback()
+	finally:
+		loader['conn'].close()
+
+#Загрузка с отбраковкой строк: для каждой загрузки свой файл и свой счетчик ошибок
+def open_reject(load_conf, table):
+	if (load_conf == None) or (load_conf.get('max_errors') == None):
+		return load_conf
+	reject = {'max_errors' : int(load_conf['max_errors']),
+			'filename' : load_conf.get('reject_path', './reject')+'/'+load_conf.get('reject_name', table)+'/'+datetime.now().strftime("%Y-%m-%d_%H%M%S_%f")+'.csv',
+			'file' : None,
+			'writer' : None,
+			'count' : 0,
+			'lock' : threading.Lock()}
+	return dict(load_conf, reject=reject)
+
+def close_reject(load_conf):
+	reject = (load_conf or {}).get('reject')
+	if (reject == None) or (reject['file'] == None):
+		return
+	reject['file'].close()
+	logging.warning(f" {reject['count']} rows were rejected, see {reject['filename']}")
+
+#Строки, отвергнутые БД, пишем в файл вместе с ошибкой; больше max_errors - загрузка падает целиком
+def reject_rows(reject, columns, data, batch_errors):
+	with reject['lock']:
+		if reject['file'] == None:
+			check_local_path(reject['filename'])
+			reject['file'] = open(reject['filename'], 'w', newline='', encoding='utf-8')
+			reject['writer'] = csv.writer(reject['file'], delimiter=';')
+			reject['writer'].writerow(list(columns) + ['ORA_ERROR'])
+		for error in batch_errors:
+			values = [value.read() if isinstance(value, oracledb.LOB) else value for value in data[error.offset]]
+			reject['writer'].writerow([value.hex() if isinstance(value, bytes) else value for value in values] + [error.message])
+		reject['count'] += len(batch_errors)
+		count = reject['count']
+	add_metric('rows_rejected', len(batch_errors))
+	if count > reject['max_errors']:
+		raise BaseException(f"{count} rows were rejected, more than max_errors {reject['max_errors']}")
+
+#Промежуточный коммит: загруженное до этого места уже не откатится
+def commit_loader(loader):
+	if loader['native']:
+		loader['conn'].commit()
+	else:
+		loader['transaction'].commit()
+		loader['transaction'] = loader['conn'].begin()
+	add_metric('round_trips')
+
+#Поток, который наследует контекст таблицы (буфер логов и тд) от запустившего его
+def context_thread(target, *args):
+	context = dict(sync_context.__dict__)
+	
+	def run():
+		sync_context.__dict__.update(context)
+		target(*args)
+		
+	return threading.Thread(target=run, daemon=True)
+
+#Лишняя сессия таблицы (часть split, писатель pipeline) берет место в max_sessions подключений стороны side, только если оно свободно
+#Ждать места нельзя: его могут держать таблицы, которые сами ждут сессий, поэтому без места работаем в уже открытых сессиях
+def try_acquire_session(side):
+	acquired = []
+	for semaphore in (getattr(sync_context, 'session_limits', None) or {}).get(side, []):
+		if not semaphore.acquire(blocking=False):
+			release_session(acquired)
+			return None
+		acquired.append(semaphore)
+	return acquired
+
+def release_session(semaphores):
+	for semaphore in reversed(semaphores):
+		semaphore.release()
+
+#Конвейерная вставка: поток-читатель наполняет ограниченную очередь пачками, писатели вставляют их в своих сессиях
+#Пока писатель ждет ответа локальной БД, читатель продолжает выбирать строки из удаленной
+def pipelined_insert(engine, columns, table, insert_data, load_conf):
+	batches = queue.Queue(maxsize=int(load_conf.get('queue_depth', 4)))
+	abort = threading.Event()
+	errors = []
+	loaders = []
+	
+	#Ждем места в очереди, пока никто из участников не упал
+	def put(item):
+		while not abort.is_set():
+			try:
+				batches.put(item, timeout=0.5)
+				return True
+			except queue.Full:
+				pass
+		return False
+	
+	def reader():
+		try:
+			for batch in batched(insert_data, loaders[0]['array_size'], loaders[0]['sizer']):
+				if not put(batch):
+					break
+		except BaseException as e:
+			errors.append(e)
+			abort.set()
+		finally:
+			if hasattr(insert_data, 'close'):
+				insert_data.close()
+			for loader in loaders:
+				put(None)
+	
+	def writer(loader):
+		try:
+			while not abort.is_set():
+				try:
+					batch = batches.get(timeout=0.5)
+				except queue.Empty:
+					continue
+				if batch == None:
+					break
+				load_batch(loader, batch)
+		except BaseException as e:
+			errors.append(e)
+			abort.set()
+	
+	#Первый писатель работает в сессии таблицы, остальным нужны свободные места в max_sessions
+	writer_sessions = []
+	try:
+		loaders.append(open_loader(engine, columns, table, load_conf))
+		for i in range(1, int(load_conf.get('writers', 1))):
+			semaphores = try_acquire_session('local')
+			if semaphores == None:
+				logging.info(f' max_sessions leaves {len(loaders)} of {load_conf["writers"]} writers for {table}')
+				break
+			writer_sessions.append(semaphores)
+			loaders.append(open_loader(engine, columns, table, load_conf))
+		logging.debug(loaders[0]['query'])
+		threads = [context_thread(reader)] + [context_thread(writer, loader) for loader in loaders]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+	except BaseException as e:
+		errors.append(e)
+		abort.set()
+	
+	#Коммитим, только если и чтение, и все писатели отработали без ошибок
+	#Сессии коммитятся по очереди, это не одна транзакция: если упал коммит одного писателя, строки уже закоммиченных остаются
+	committed = 0
+	for loader in loaders:
+		try:
+			close_loader(loader, errors == [])
+			if errors == []:
+				committed += 1
+		except BaseException as e:
+			errors.append(e)
+	if errors and committed:
+		logging.error(f' {committed} of {len(loaders)} writers had already committed, their rows stay in {table}')
+	for semaphores in writer_sessions:
+		release_session(semaphores)
+	if errors:
+		logging.error('Error executing request:')
+		logging.error(f"INSERT INTO {table} ({','.join(columns)})")
+		logging.error(str(errors[0]))
+		return None
+	return True
+
+#Вставка данных в таблицу	
+def insert_table_data(engine, columns, table, insert_data, load_conf=None):
+	load_conf = open_reject(load_conf, table)
+	try:
+		if (load_conf != None) and load_conf.get('pipeline', False):
+			return pipelined_insert(engine, columns, table, insert_data, load_conf)
+		return serial_insert(engine, columns, table, insert_data, load_conf)
+	finally:
+		close_reject(load_conf)
+
+#Вставка одним потоком: чтение и запись пачек по очереди
+def serial_insert(engine, columns, table, insert_data, load_conf):
+	loader = None
+	try:
+		loader = open_loader(engine, columns, table, load_conf)
+		logging.debug(loader['query'])
+		for batch in batched(insert_data, loader['array_size'], loader['sizer']):
+			load_batch(loader, batch)
+		close_loader(loader, True)
+		return True
+	except BaseException as e:
+		logging.error('Error executing request:')
+		logging.error(loader['query'] if loader != None else f"INSERT INTO {table} ({','.join(columns)})")
+		logging.error(str(e))
+		if loader != None:
+			try:
+				close_loader(loader, False)
+			except BaseException as e:
+				logging.error(str(e))
+		return None
 		
 def format_data_type(col):
 	data_type = col["DATA_TYPE"]
 	
-	if data_type in ("VARCHAR2", "CHAR", "NVARCHAR2"):
+	if data_type in ("VARCHAR2", "CHAR", "NVARCHAR2", "NCHAR", "RAW"):
 		return f"{data_type}({col['DATA_LENGTH']})"
 		
 	if data_type == "NUMBER":
@@ -206,12 +857,11 @@ def build_constrains_ddl(constrains, cons_columns):
 	return ddl
 
 #Собираем ddl	
-def get_ddl(columns_conf, remote_table, local_table):
-	columns = get_table_data(remote_table['engine'], ['*'], 'all_tab_columns'+remote_table['postfix'], f" WHERE table_name='{remote_table['name']}'")
-
-	constraints = get_table_data(remote_table['engine'], ['*'], 'all_constraints'+remote_table['postfix'], f" WHERE table_name='{remote_table['name']}'")
+#Столбцы берем из уже выгруженных метаданных (get_tables_columns)
+def get_ddl(columns, remote_table, local_table):
+	constraints = get_table_data(remote_table['engine'], ['*'], 'all_constraints'+remote_table['postfix'], f" WHERE table_name='{remote_table['name']}' AND {owner_condition(remote_table)}")
 
-	cons_columns = get_table_data(remote_table['engine'], ['*'], 'all_cons_columns'+remote_table['postfix'], f" WHERE table_name='{remote_table['name']}'")
+	cons_columns = get_table_data(remote_table['engine'], ['*'], 'all_cons_columns'+remote_table['postfix'], f" WHERE table_name='{remote_table['name']}' AND {owner_condition(remote_table)}")
 	
 	col_ddls = build_columns_ddl(columns)
 	
@@ -239,7 +889,7 @@ def create_table(columns_conf, local_conf, remote_conf, one_db, show_only):
 			columns_str = ','.join(map_columns(columns_conf))
 		query = f"CREATE TABLE {local_conf['prefix']}{local_conf['name']}{local_conf['postfix']} AS (SELECT {columns_str} FROM {remote_conf['prefix']}{remote_conf['name']}{remote_conf['postfix']})"
 	else:
-		query = get_ddl(columns_conf, remote_conf, local_conf)
+		query = get_ddl(columns_conf['remote_dictionary'], remote_conf, local_conf)
 	if show_only == 'yes':
 		answer = query
 	else:
@@ -254,7 +904,7 @@ def create_table(columns_conf, local_conf, remote_conf, one_db, show_only):
 	return answer
 
 #Синхронизация через truncate
-def truncate_sync(columns_conf, local_conf, remote_conf, one_db):
+def truncate_sync(columns_conf, local_conf, remote_conf, one_db, load_conf=None):
 	answer = exec_query(local_conf['engine'],
 						f"TRUNCATE TABLE {local_conf['prefix']}{local_conf['name']}{local_conf['postfix']}")
 	if answer != None:
@@ -263,64 +913,503 @@ def truncate_sync(columns_conf, local_conf, remote_conf, one_db):
 			
 			answer = exec_query(local_conf['engine'],query)
 		else:
-			answer = insert_table_data(local_conf['engine'], columns_conf['local_columns'], f"{local_conf['prefix']}{local_conf['name']}{local_conf['postfix']}", remote_conf['data'])
+			answer = insert_table_data(local_conf['engine'], columns_conf['local_columns'], f"{local_conf['prefix']}{local_conf['name']}{local_conf['postfix']}", remote_conf['data'], load_conf)
 		#Пробуем вернуть все в зад, если при в ставке данных из удаленной таблицы возникла ошибка
+		#Повторный TRUNCATE убирает и строки, уже закоммиченные частью писателей pipeline
 		if answer == None:
 			exec_query(local_conf['engine'],
 						f"TRUNCATE TABLE {local_conf['prefix']}{local_conf['name']}{local_conf['postfix']}")
-			insert_table_data(local_conf['engine'], columns_conf['local_columns'], f"{local_conf['prefix']}{local_conf['name']}{local_conf['postfix']}", local_conf['data'])
+			insert_table_data(local_conf['engine'], columns_conf['local_columns'], f"{local_conf['prefix']}{local_conf['name']}{local_conf['postfix']}", local_conf['data'], load_conf)
 		
 	return answer
 		
+
+#Условие "ключ больше заданного" в порядке сортировки по ключу (столбцы ключа не NULL)
+def key_after_condition(columns, values):
+	conditions = []
+	for i, column in enumerate(columns):
+		parts = [f"{prev_column} = {sql_literal(value)}" for prev_column, value in zip(columns[:i], values[:i])]
+		parts.append(f"{column} > {sql_literal(values[i])}")
+		conditions.append('('+' AND '.join(parts)+')')
+	return '('+' OR '.join(conditions)+')'
+
+#Полная перезагрузка с контрольными точками: строки идут по порядку ключа, коммит каждые N пачек,
+#последний закоммиченный ключ сохраняется в файл состояния, следующий запуск продолжает с него
+def checkpoint_sync(columns_conf, local_conf, remote_conf, load_conf, checkpoint_conf):
+	table = f"{local_conf['prefix']}{local_conf['name']}{local_conf['postfix']}"
+	key_columns, remote_columns = get_key_columns(columns_conf)
+	nullable = [column for column in key_columns if column in columns_conf['nullable_columns']]
+	if nullable:
+		logging.error(' checkpoint needs key columns declared NOT NULL in the local table, nullable: '+', '.join(nullable))
+		return None
+	state = load_state(checkpoint_conf['config'], checkpoint_conf['state_key'])
+	if state == None:
+		return None
+	last_key = state.get('checkpoint')
+	remote_key_columns = [remote_column_name(columns_conf, column) for column in key_columns]
+	where = ''
+	if last_key == None:
+		if exec_query(local_conf['engine'], f"TRUNCATE TABLE {table}") == None:
+			return None
+	else:
+		logging.info(f' Resuming the load of the table {local_conf["name"]} after the key {last_key}')
+		#Строки после контрольной точки могли закоммититься до сбоя, не успев попасть в файл состояния
+		if exec_query(local_conf['engine'], f"DELETE FROM {table} WHERE {key_after_condition(key_columns, last_key)}") == None:
+			return None
+		where = 'WHERE '+key_after_condition(remote_key_columns, last_key)
+	rows = get_big_table_data(remote_conf['engine'],
+							map_columns(columns_conf),
+							remote_conf['prefix']+remote_conf['name']+remote_conf['postfix'],
+							where+' '+key_order_clause(remote_key_columns),
+							load_conf.get('fetch_sizer'),
+							load_conf.get('fetch_lobs'))
+	loader = None
+	load_conf = open_reject(load_conf, table)
+	try:
+		loader = open_loader(local_conf['engine'], columns_conf['local_columns'], table, load_conf)
+		logging.debug(loader['query'])
+		batches = 0
+		for batch in batched(rows, loader['array_size'], loader['sizer']):
+			load_batch(loader, batch)
+			batches += 1
+			if batches % checkpoint_conf['batches'] == 0:
+				commit_loader(loader)
+				if save_state(checkpoint_conf['config'], checkpoint_conf['state_key'],
+								{'checkpoint' : [getattr(batch[-1], column) for column in key_columns]}) == None:
+					raise BaseException('Failed to save the checkpoint')
+		close_loader(loader, True)
+	except BaseException as e:
+		logging.error('Error executing request:')
+		logging.error(loader['query'] if loader != None else f"INSERT INTO {table} ({','.join(columns_conf['local_columns'])})")
+		logging.error(str(e))
+		if loader != None:
+			try:
+				close_loader(loader, False)
+			except BaseException as e:
+				logging.error(str(e))
+		logging.error(f' The load of the table {local_conf["name"]} stopped, the next run continues from the last checkpoint')
+		return None
+	finally:
+		close_reject(load_conf)
+	#Таблица загружена целиком, следующий запуск начнет с нуля
+	if save_state(checkpoint_conf['config'], checkpoint_conf['state_key'], {'checkpoint' : None}) == None:
+		return None
+	return True
+
+#Поиск изменений слиянием отсортированных по ключу потоков: новые, изменившиеся и удаленные строки
+def merge_delta(remote_rows, local_rows, key_columns, compare_columns):
+	local_rows = iter(local_rows)
 	
-def answer_to_strlist(answer):
-	result_list = []
-	for element in answer:
-		result_list.append(element[list(element.keys())[0]])	
-	return result_list
+	def next_local(prev_key):
+		row = next(local_rows, None)
+		if row == None:
+			return None, None
+		key = sort_key(getattr(row, column) for column in key_columns)
+		if (prev_key != None) and (key < prev_key):
+			raise BaseException(f'Local rows are not sorted by key: {key} after {prev_key}')
+		return row, key
+	
+	local_row, local_key = next_local(None)
+	prev_key = None
+	skipped = 0
+	for row in remote_rows:
+		key = sort_key(getattr(row, column) for column in key_columns)
+		if (prev_key != None) and (key < prev_key):
+			raise BaseException(f'Remote rows are not sorted by key: {key} after {prev_key}')
+		prev_key = key
+		#Локальные строки с ключами меньше текущего в удаленной таблице отсутствуют
+		while (local_row != None) and (local_key < key):
+			yield 'delete', local_row
+			local_row, local_key = next_local(local_key)
+		if (local_row != None) and (local_key == key):
+			if any(getattr(row, column) != getattr(local_row, column) for column in compare_columns):
+				yield 'update', row
+			else:
+				skipped += 1
+			local_row, local_key = next_local(local_key)
+		else:
+			yield 'insert', row
+	while local_row != None:
+		yield 'delete', local_row
+		local_row, local_key = next_local(local_key)
+	add_metric('rows_skipped', skipped)
+
+#Применение изменений пачками: вставки и обновления через MERGE, удаления через DELETE
+def apply_delta(engine, columns_conf, key_columns, table, delta):
+	local_columns = columns_conf['local_columns']
+	queries = {'upsert' : (f"MERGE INTO {table} l USING (SELECT {','.join(f':{column} AS {column}' for column in local_columns)} FROM dual) r "
+							f"ON ({key_match_condition(columns_conf, key_columns, ['r.'+column for column in key_columns])}) "
+							+ merge_clauses(columns_conf, key_columns)),
+				'delete' : f"DELETE FROM {table} l WHERE {key_match_condition(columns_conf, key_columns, [':'+column for column in key_columns])}"}
+	batches = {'upsert' : [], 'delete' : []}
+	counts = {'insert' : 0, 'update' : 0, 'delete' : 0}
+	try:
+		with engine.begin() as conn:
+			for operation, row in delta:
+				counts[operation] += 1
+				if operation == 'delete':
+					batch = batches['delete']
+					batch.append({column: getattr(row, column) for column in key_columns})
+				else:
+					batch = batches['upsert']
+					batch.append({column: getattr(row, column) for column in local_columns})
+				if len(batch) >= 5000:
+					conn.execute(sa.text(queries['delete' if operation == 'delete' else 'upsert']), batch)
+					add_metric('batches')
+					add_metric('round_trips')
+					batch.clear()
+			for operation in batches:
+				if batches[operation]:
+					conn.execute(sa.text(queries[operation]), batches[operation])
+					add_metric('batches')
+					add_metric('round_trips')
+		add_metric('rows_written', sum(counts.values()))
+		return counts
+	except BaseException as e:
+		logging.error('Error applying changes to the table '+table)
+		logging.error(str(e))
+		return None
+
+#Кол-во изменений, считается на стороне БД
+def server_delta_counts(columns_conf, local_conf, remote_conf):
+	key_columns, remote_columns = get_key_columns(columns_conf)
+	local_name = f"{local_conf['prefix']}{local_conf['name']}{local_conf['postfix']}"
+	remote_name = f"{remote_conf['prefix']}{remote_conf['name']}{remote_conf['postfix']}"
+	update_columns = [column for column in columns_conf['local_columns'] if column not in key_columns]
+	counts = {'insert' : server_diff_count(columns_conf, local_conf, remote_conf), 'update' : 0}
+	if update_columns:
+		answer = get_table_data(local_conf['engine'],
+								['COUNT(*) AS CNT'],
+								f"{local_name} l JOIN (SELECT {','.join(remote_select_columns(columns_conf, 'r.'))} FROM {remote_name} r {remote_filter(remote_conf, 'WHERE')}) r "
+								f"ON ({key_match_condition(columns_conf, key_columns, ['r.'+column for column in key_columns])})",
+								f"WHERE {columns_changed_condition(columns_conf, update_columns)}")
+		counts['update'] = answer[0]['CNT'] if answer != None else None
+	#По части удаленной таблицы удаления не определить
+	if remote_filter(remote_conf, 'WHERE') != '':
+		counts['delete'] = 0
+		return counts
+	answer = get_table_data(local_conf['engine'],
+							['COUNT(*) AS CNT'],
+							f"{local_name} l",
+							f"WHERE NOT EXISTS (SELECT 1 FROM {remote_name} r WHERE {key_match_condition(columns_conf, key_columns, ['r.'+remote_column_name(columns_conf, column) for column in key_columns])})")
+	counts['delete'] = answer[0]['CNT'] if answer != None else None
+	return counts
+
+#Синхронизация изменений по ключу: вставка новых, обновление изменившихся и удаление лишних строк
+def merge_sync(columns_conf, local_conf, remote_conf, one_db, show_only):
+	key_columns, remote_columns = get_key_columns(columns_conf)
+	local_name = f"{local_conf['prefix']}{local_conf['name']}{local_conf['postfix']}"
+	remote_name = f"{remote_conf['prefix']}{remote_conf['name']}{remote_conf['postfix']}"
+	if one_db:
+		if show_only == 'yes':
+			return server_delta_counts(columns_conf, local_conf, remote_conf)
+		#Обе таблицы видны из одной БД - MERGE и DELETE на сервере в одной транзакции
+		queries = [f"MERGE INTO {local_name} l USING (SELECT {','.join(remote_select_columns(columns_conf, 'r.'))} FROM {remote_name} r {remote_filter(remote_conf, 'WHERE')}) r "
+					f"ON ({key_match_condition(columns_conf, key_columns, ['r.'+column for column in key_columns])}) "
+					+ merge_clauses(columns_conf, key_columns)]
+		#По части удаленной таблицы удаления не определить
+		if remote_filter(remote_conf, 'WHERE') == '':
+			queries.append(f"DELETE FROM {local_name} l WHERE NOT EXISTS (SELECT 1 FROM {remote_name} r "
+							f"WHERE {key_match_condition(columns_conf, key_columns, ['r.'+remote_column_name(columns_conf, column) for column in key_columns])})")
+		return exec_transaction(local_conf['engine'], queries)
+	
+	remote_data = get_big_table_data(remote_conf['engine'],
+									map_columns(columns_conf),
+									remote_name,
+									remote_filter(remote_conf, 'WHERE')+' '+key_order_clause([remote_column_name(columns_conf, column) for column in key_columns]))
+	local_data = get_big_table_data(local_conf['engine'],
+									columns_conf['local_columns'],
+									local_name,
+									key_order_clause(key_columns))
+	delta = merge_delta(remote_data, local_data, key_columns,
+						[column for column in columns_conf['local_columns'] if column not in key_columns])
+	if remote_filter(remote_conf, 'WHERE') != '':
+		delta = (change for change in delta if change[0] != 'delete')
+	if show_only == 'yes':
+		counts = {'insert' : 0, 'update' : 0, 'delete' : 0}
+		for operation, row in delta:
+			counts[operation] += 1
+		return counts
+	return apply_delta(local_conf['engine'], columns_conf, key_columns, local_name, delta)
+
+#Условие на владельца таблицы для словарей данных
+#Схема в запросах пишется без кавычек, поэтому в словаре она в верхнем регистре, как бы ее ни указали в конфиге
+def owner_condition(table_conf, column='owner'):
+	if table_conf['prefix'] != '':
+		return f"{column} = UPPER('{table_conf['prefix'][:-1]}')"
+	return f"{column} = (SELECT USER FROM dual{table_conf['postfix']})"
+
+#Комментарий, которым помечены служебные таблицы подмены
+swap_marker = 'dbSync swap table'
+
+#Имя служебной таблицы подмены: хэш полного имени не дает совпасть таблицам с общим началом имени (не длиннее 30 символов)
+def swap_table_name(table_conf, suffix):
+	digest = hashlib.md5((table_conf['prefix']+table_conf['name']).upper().encode()).hexdigest()[:8].upper()
+	return f"{table_conf['name'][:17]}_{digest}_{suffix}"
+
+#Комментарий таблицы, None - таблицы нет
+def get_table_comment(table_conf, name):
+	answer = get_table_data(table_conf['engine'],
+							['comments'],
+							'all_tab_comments'+table_conf['postfix'],
+							f"WHERE table_name='{name}' AND table_type='TABLE' AND {owner_condition(table_conf)}")
+	if answer == None:
+		return None
+	if answer == []:
+		return {'exists' : False, 'comment' : None}
+	return {'exists' : True, 'comment' : answer[0]['COMMENTS']}
+
+def set_table_comment(table_conf, name, comment):
+	return exec_query(table_conf['engine'], f"COMMENT ON TABLE {table_conf['prefix']}{name}{table_conf['postfix']} IS {sql_literal(comment or '')}")
+
+#Удаление служебной таблицы, оставшейся от прошлого запуска; чужую таблицу с таким же именем не трогаем
+def drop_swap_table(table_conf, name):
+	answer = get_table_comment(table_conf, name)
+	if answer == None:
+		return None
+	if not answer['exists']:
+		return True
+	if answer['comment'] != swap_marker:
+		logging.error(f" Table {name} already exists and was not created by sync_type swap, rename or drop it")
+		return None
+	return exec_query(table_conf['engine'], f"DROP TABLE {table_conf['prefix']}{name}{table_conf['postfix']} PURGE")
+
+#Подмена через переименование: живая таблица отсутствует только между двумя RENAME
+def rename_swap(local_conf, staging):
+	local_name = f"{local_conf['prefix']}{local_conf['name']}{local_conf['postfix']}"
+	old = swap_table_name(local_conf, 'OLD')
+	old_name = f"{local_conf['prefix']}{old}{local_conf['postfix']}"
+	if drop_swap_table(local_conf, old) == None:
+		return None
+	#Комментарий живой таблицы переходит к новой, а старая помечается как служебная
+	live = get_table_comment(local_conf, local_conf['name'])
+	if live == None:
+		return None
+	if exec_query(local_conf['engine'], f"ALTER TABLE {local_name} RENAME TO {old}") == None:
+		return None
+	if (set_table_comment(local_conf, old, swap_marker) == None) or \
+		(exec_query(local_conf['engine'], f"ALTER TABLE {local_conf['prefix']}{staging}{local_conf['postfix']} RENAME TO {local_conf['name']}") == None):
+		exec_query(local_conf['engine'], f"ALTER TABLE {old_name} RENAME TO {local_conf['name']}")
+		set_table_comment(local_conf, local_conf['name'], live['comment'])
+		return None
+	set_table_comment(local_conf, local_conf['name'], live['comment'])
+	exec_query(local_conf['engine'], f"ALTER TABLE {local_name} LOGGING")
+	return exec_query(local_conf['engine'], f"DROP TABLE {old_name} PURGE")
+
+#Обмен заменяет данные только одной секции: при нескольких секциях в остальных остались бы старые строки
+def check_exchange_partition(local_conf, partition):
+	answer = get_table_data(local_conf['engine'],
+							['partition_name'],
+							'all_tab_partitions'+local_conf['postfix'],
+							f"WHERE table_name='{local_conf['name']}' AND {owner_condition(local_conf, 'table_owner')}")
+	if answer == None:
+		return None
+	partitions = [row['PARTITION_NAME'] for row in answer]
+	if partitions != [partition.upper()]:
+		logging.error(f" swap_method exchange needs a table with the single partition {partition}, table {local_conf['name']} has: {', '.join(partitions) or 'no partitions'}")
+		return None
+	return True
+
+#Подмена через EXCHANGE PARTITION: индексы и гранты живой таблицы сохраняются
+def exchange_swap(local_conf, staging, partition):
+	local_name = f"{local_conf['prefix']}{local_conf['name']}{local_conf['postfix']}"
+	staging_name = f"{local_conf['prefix']}{staging}{local_conf['postfix']}"
+	#WITH VALIDATION: строка вне границ секции дает ошибку, а не попадает в секцию молча
+	if exec_query(local_conf['engine'],
+				f"ALTER TABLE {local_name} EXCHANGE PARTITION {partition} WITH TABLE {staging_name} WITH VALIDATION UPDATE GLOBAL INDEXES") == None:
+		return None
+	#Локальные индексы обмененной секции становятся UNUSABLE
+	answer = get_table_data(local_conf['engine'],
+							['index_owner', 'index_name', 'partition_name'],
+							'all_ind_partitions'+local_conf['postfix'],
+							f"WHERE status = 'UNUSABLE' AND partition_name = '{partition}' AND (index_owner, index_name) IN "
+							f"(SELECT owner, index_name FROM all_indexes{local_conf['postfix']} WHERE table_name = '{local_conf['name']}' AND {owner_condition(local_conf, 'table_owner')})")
+	if answer == None:
+		return None
+	for index in answer:
+		if exec_query(local_conf['engine'], f"ALTER INDEX {index['INDEX_OWNER']}.{index['INDEX_NAME']} REBUILD PARTITION {index['PARTITION_NAME']}") == None:
+			return None
+	#В staging теперь старые данные
+	return drop_swap_table(local_conf, staging)
+
+#CTAS не переносит значения по умолчанию - задаем их staging таблице
+def copy_column_defaults(local_conf, staging_name):
+	answer = get_table_data(local_conf['engine'],
+							['column_name', 'data_default'],
+							'all_tab_columns'+local_conf['postfix'],
+							f"WHERE table_name='{local_conf['name']}' AND {owner_condition(local_conf)} AND default_length > 0")
+	if answer == None:
+		return None
+	for column in answer:
+		if (column['DATA_DEFAULT'] or '').strip() == '':
+			continue
+		if exec_query(local_conf['engine'], f"ALTER TABLE {staging_name} MODIFY {column['COLUMN_NAME']} DEFAULT {column['DATA_DEFAULT'].strip()}") == None:
+			return None
+	return True
+
+#Синхронизация через промежуточную таблицу: живая таблица не очищается, читатели видят старые данные до подмены
+def swap_sync(columns_conf, local_conf, remote_conf, one_db, load_conf, swap_conf):
+	if columns_conf['identity_local_columns'] != []:
+		logging.error(f" sync_type swap does not support identity columns ({', '.join(columns_conf['identity_local_columns'])}), table {local_conf['name']}")
+		return None
+	if (swap_conf['method'] == 'exchange') and (check_exchange_partition(local_conf, swap_conf['partition']) == None):
+		return None
+	staging = swap_table_name(local_conf, 'STG')
+	staging_name = f"{local_conf['prefix']}{staging}{local_conf['postfix']}"
+	local_name = f"{local_conf['prefix']}{local_conf['name']}{local_conf['postfix']}"
+	if drop_swap_table(local_conf, staging) == None:
+		return None
+	#Структуру копирует сам сервер: типы столбцов (длина в символах, NUMBER(*,0)) совпадают с живой таблицей, как требует EXCHANGE
+	if exec_query(local_conf['engine'], f"CREATE TABLE {staging_name} NOLOGGING AS SELECT * FROM {local_name} WHERE 1=0") == None:
+		return None
+	if (set_table_comment(local_conf, staging, swap_marker) == None) or (copy_column_defaults(local_conf, staging_name) == None):
+		drop_swap_table(local_conf, staging)
+		return None
+	if one_db:
+		answer = exec_query(local_conf['engine'],
+							f"INSERT /*+ APPEND */ INTO {staging_name} ({','.join(columns_conf['local_columns'])}) "
+							f"SELECT {','.join(remote_select_columns(columns_conf))} FROM {remote_conf['prefix']}{remote_conf['name']}{remote_conf['postfix']}")
+	else:
+		answer = insert_table_data(local_conf['engine'], columns_conf['local_columns'], staging_name, remote_conf['data'], load_conf)
+	if answer != None:
+		if swap_conf['method'] == 'exchange':
+			answer = exchange_swap(local_conf, staging, swap_conf['partition'])
+		else:
+			answer = rename_swap(local_conf, staging)
+	#Живая таблица не тронута, достаточно убрать staging
+	if answer == None:
+		drop_swap_table(local_conf, staging)
+	return answer
+	
+#Условие на список таблиц (в IN не больше 1000 элементов)
+def names_condition(names, column='table_name'):
+	chunks = [names[i:i+1000] for i in range(0, len(names), 1000)]
+	return '('+' OR '.join(f"{column} IN ({','.join(sql_literal(name) for name in chunk)})" for chunk in chunks)+')'
+
+#Ключ кэша метаданных в файле состояния (без пароля)
+def metadata_cache_key(db_conf):
+	return f"metadata.{db_conf['db_user']}@{db_conf['db_host']}/{db_conf['db_name']}.{db_conf['scheme_name']}{db_conf['postfix']}"
+
+#Метаданные сразу для всех таблиц задания: по одному запросу к каждому представлению словаря
+#Столбцы из кэша берем, если last_ddl_time таблицы не изменилось
+def fetch_metadata(table_conf, names, stats=False, general_config=None, cache_key=None):
+	names = sorted(set(names))
+	result = {'columns' : {name : [] for name in names}, 'num_rows' : {}}
+	if names == []:
+		return result
+	condition = f"{owner_condition(table_conf)} AND {names_condition(names)}"
+	if stats:
+		answer = get_table_data(table_conf['engine'],
+								['table_name', 'num_rows'],
+								'all_tables'+table_conf['postfix'],
+								f"WHERE {condition}")
+		if answer == None:
+			return None
+		result['num_rows'] = {row['TABLE_NAME'] : row['NUM_ROWS'] for row in answer}
+	
+	stale = names
+	if cache_key != None:
+		cache = load_state(general_config, cache_key)
+		answer = get_table_data(table_conf['engine'],
+								['object_name', 'last_ddl_time'],
+								'all_objects'+table_conf['postfix'],
+								f"WHERE object_type IN ('TABLE', 'VIEW') AND {owner_condition(table_conf)} AND {names_condition(names, 'object_name')}")
+		if (cache == None) or (answer == None):
+			return None
+		ddl_times = {row['OBJECT_NAME'] : row['LAST_DDL_TIME'] for row in answer}
+		stale = []
+		for name in names:
+			if (name in ddl_times) and (cache.get(name, {}).get('ddl_time') == ddl_times[name]):
+				result['columns'][name] = cache[name]['columns']
+			else:
+				stale.append(name)
+	if stale == []:
+		return result
+	
+	answer = get_table_data(table_conf['engine'],
+							['table_name', 'column_name', 'column_id', 'nullable', 'data_type', 'data_length',
+							'data_precision', 'data_scale', 'identity_column'],
+							'all_tab_columns'+table_conf['postfix'],
+							f"WHERE {owner_condition(table_conf)} AND {names_condition(stale)} ORDER BY table_name, column_id")
+	if answer == None:
+		return None
+	for row in answer:
+		result['columns'][row.pop('TABLE_NAME')].append(row)
+	
+	if cache_key != None:
+		#Удаленные таблицы убираем из кэша
+		save_state(general_config, cache_key,
+					{name : {'ddl_time' : ddl_times[name], 'columns' : result['columns'][name]} if name in ddl_times else None
+					for name in stale})
+	return result
+
+#Метаданные локальных и удаленных таблиц задания
+def get_job_metadata(sync_conf, local_conf, remote_conf, general_config, show_only):
+	cached = get_option('metadata_cache', {}, sync_conf, general_config, False)
+	metadata = {}
+	for side, table_conf, names in (('local', local_conf, [list(table.keys())[0] for table in sync_conf['tables']]),
+									('remote', remote_conf, [list(table.values())[0] for table in sync_conf['tables']])):
+		db_conf = sync_conf[side+'_db']
+		metadata[side] = fetch_metadata(table_conf,
+										names,
+										(side == 'local') and (show_only == 'yes'),
+										general_config,
+										metadata_cache_key(db_conf) if cached else None)
+	return metadata
+
+#Кол-во строк локальной таблицы: по статистике или полным подсчетом
+def count_lines(local_conf, num_rows, use_num_rows):
+	if use_num_rows and (num_rows != None):
+		return num_rows
+	answer = get_table_data(local_conf['engine'],
+							['COUNT(*)'],
+							f"{local_conf['prefix']}{local_conf['name']}{local_conf['postfix']}")
+	if answer == None:
+		return None
+	return answer[0]['COUNT(*)']
 
 #Получаем столбцы таблиц
-def get_tables_columns(conf, local_conf, remote_conf):
+def get_tables_columns(conf, local_conf, remote_conf, metadata=None):
 	
 	result = {'remote_columns' : [],
 			'local_columns' : [],
 			'map_columns' : {},
 			'identity_local_columns' : [],
+			'nullable_columns' : [],
+			'column_types' : {},
+			'remote_dictionary' : [],
+			'local_dictionary' : [],
+			'num_rows' : None,
 			'lines_count' : 0}
-	#Столбцы удаленной таблицы		
-	answer = get_table_data(remote_conf['engine'],
-									['column_name'],
-									'all_tab_columns'+remote_conf['postfix'],
-									f"WHERE table_name='{remote_conf['name']}'")
-	if (answer == None) or (answer == []):
-		result['remote_columns'] = answer
+	#Без общих метаданных задания запрашиваем словарь только для этой таблицы
+	if (metadata == None) or (metadata['remote'] == None):
+		remote_metadata = fetch_metadata(remote_conf, [remote_conf['name']])
+	else:
+		remote_metadata = metadata['remote']
+	if (metadata == None) or (metadata['local'] == None):
+		local_metadata = fetch_metadata(local_conf, [local_conf['name']])
+	else:
+		local_metadata = metadata['local']
+	#Столбцы удаленной таблицы
+	if remote_metadata == None:
+		result['remote_columns'] = None
+		return result
+	result['remote_dictionary'] = remote_metadata['columns'][remote_conf['name']]
+	if result['remote_dictionary'] == []:
 		return result
-	result['remote_columns'] = answer_to_strlist(answer)
+	result['remote_columns'] = [row['COLUMN_NAME'] for row in result['remote_dictionary']]
 	#Проверяем существование локальной таблицы
-	answer = get_table_data(local_conf['engine'],
-							['table_name'],
-							'all_tables'+local_conf['postfix'],
-							f"WHERE table_name='{local_conf['name']}'")
-	if (answer == None) or (answer == []):
-		result['local_columns'] = answer
-	else:
-		#Получаем кол-во строк таблицы
-		answer = get_table_data(local_conf['engine'],
-								['COUNT(*)'],
-								f"{local_conf['prefix']}{local_conf['name']}{local_conf['postfix']}")
-		result['lines_count'] = answer[0]['COUNT(*)']
+	if local_metadata == None:
+		result['local_columns'] = None
+	elif local_metadata['columns'][local_conf['name']] != []:
+		result['local_dictionary'] = local_metadata['columns'][local_conf['name']]
+		result['num_rows'] = local_metadata['num_rows'].get(local_conf['name'])
 		#Получаем столбцы, отдельно идентити
-		answer = get_table_data(local_conf['engine'],
-								['column_name'],
-								'all_tab_columns'+local_conf['postfix'],
-								f"WHERE table_name='{local_conf['name']}' AND IDENTITY_COLUMN='NO'")
-		result['local_columns'] = answer_to_strlist(answer)
-		
-		answer = get_table_data(local_conf['engine'],
-								['column_name'],
-								'all_tab_columns'+local_conf['postfix'],
-								f"WHERE table_name='{local_conf['name']}' AND IDENTITY_COLUMN='YES'")
-		result['identity_local_columns'] = answer_to_strlist(answer)
+		answer = [row for row in result['local_dictionary'] if row['IDENTITY_COLUMN'] == 'NO']
+		result['local_columns'] = [row['COLUMN_NAME'] for row in answer]
+		result['nullable_columns'] = [row['COLUMN_NAME'] for row in answer if row['NULLABLE'] == 'Y']
+		result['column_types'] = {row['COLUMN_NAME']: row for row in answer}
+		result['identity_local_columns'] = [row['COLUMN_NAME'] for row in result['local_dictionary'] if row['IDENTITY_COLUMN'] == 'YES']
 		#Выкидываем из столбцов удаленной таблицы те, которые в локальной идентити
 		for column in result['identity_local_columns']:
 			if column in result['remote_columns']:
@@ -359,23 +1448,482 @@ def map_columns(columns_conf):
 	return columns
 
 
-#Сравнение таблиц
-def compare_tables(remote, local, columns, one_db):
-	if 'diff_keys' in columns:
-		key_columns = tuple(columns['diff_keys'])
-		if columns['map_columns'] != {}:
-			remote_columns = []
-			for column in columns['diff_keys']:
-				if column in columns['map_columns']:
-					column = f"{columns['map_columns'][column]} AS {column}"
-				remote_columns.append(column)
+#Значение в виде литерала для подстановки в запрос
+def sql_literal(value):
+	if value == None:
+		return 'NULL'
+	if isinstance(value, datetime):
+		if value.microsecond == 0:
+			return f"TO_DATE('{value.strftime('%Y-%m-%d %H:%M:%S')}', 'YYYY-MM-DD HH24:MI:SS')"
+		return f"TIMESTAMP '{value.strftime('%Y-%m-%d %H:%M:%S.%f')}'"
+	if isinstance(value, (int, float, Decimal)):
+		return str(value)
+	#RAW ключи
+	if isinstance(value, (bytes, bytearray)):
+		return f"HEXTORAW('{value.hex().upper()}')"
+	return "'"+str(value).replace("'", "''")+"'"
+
+#Дополнительное условие выборки из удаленной таблицы (например, водяной знак)
+def remote_filter(remote_conf, prefix):
+	if remote_conf.get('filter', '') == '':
+		return ''
+	return f"{prefix} {remote_conf['filter']}"
+
+#Имя столбца в удаленной таблице
+def remote_column_name(columns_conf, column):
+	if column in columns_conf['map_columns']:
+		return columns_conf['map_columns'][column]
+	return column
+
+#Выражения удаленной таблицы в порядке локальных столбцов
+def remote_select_columns(columns_conf, alias=''):
+	columns = []
+	for column in columns_conf['local_columns']:
+		remote_name = remote_column_name(columns_conf, column)
+		if remote_name != column:
+			columns.append(f"{alias}{remote_name} AS {column}")
+		else:
+			columns.append(alias+column)
+	return columns
+
+#Столбцы ключа сравнения: локальные имена и выражения для выборки из удаленной таблицы
+def get_key_columns(columns):
+	if 'diff_key' in columns:
+		key_columns = tuple(columns['diff_key'])
+	else:
+		#LOB по умолчанию в ключ не входят: большие значения сравнивать в памяти дорого
+		column_types = columns.get('column_types', {})
+		key_columns = tuple(column for column in columns['local_columns']
+							if (column not in column_types) or (column_types[column]['DATA_TYPE'] not in lob_types)) or tuple(columns['local_columns'])
+	remote_columns = []
+	for column in key_columns:
+		remote_name = remote_column_name(columns, column)
+		if remote_name != column:
+			column = f"{remote_name} AS {column}"
+		remote_columns.append(column)
+	return key_columns, remote_columns
+
+#Сортировка по ключу, NULL идут последними (так же как в sort_key)
+def key_order_clause(key_columns):
+	return 'ORDER BY '+', '.join(f'{column} NULLS LAST' for column in key_columns)
+
+#Ключ для сравнения в python: NULL больше любого значения и равен другому NULL
+def sort_key(values):
+	return tuple((value is None, value) for value in values)
+
+#Сравнение отсортированных по ключу потоков слиянием, в памяти держим только текущие строки
+def merge_compare(remote_rows, local_keys, key_columns):
+	local_key = None
+	local_done = False
+	prev_key = None
+	skipped = 0
+	for row in remote_rows:
+		key = sort_key(getattr(row, column) for column in key_columns)
+		if (prev_key != None) and (key < prev_key):
+			raise BaseException(f'Remote rows are not sorted by key: {key} after {prev_key}')
+		prev_key = key
+		#Догоняем локальный поток до текущего ключа
+		while (not local_done) and ((local_key == None) or (local_key < key)):
+			local_row = next(local_keys, None)
+			if local_row == None:
+				local_done = True
+				break
+			next_key = sort_key(local_row)
+			if (local_key != None) and (next_key < local_key):
+				raise BaseException(f'Local rows are not sorted by key: {next_key} after {local_key}')
+			local_key = next_key
+		if (not local_done) and (local_key == key):
+			skipped += 1
+			continue
+		yield row
+	add_metric('rows_skipped', skipped)
+
+#Приведение столбца к строке для хэширования: формат задан явно, чтобы хэш не зависел от NLS сессии
+#Время с часовым поясом приводится к UTC; тип неизвестен (None) - столбец остается как есть
+def hash_text_expr(expr, column_type=None):
+	data_type = (column_type or {}).get('DATA_TYPE', '')
+	if data_type == 'DATE':
+		return f"TO_CHAR({expr}, 'YYYY-MM-DD HH24:MI:SS')"
+	if data_type.startswith('TIMESTAMP') and data_type.endswith('TIME ZONE'):
+		return f"TO_CHAR(SYS_EXTRACT_UTC({expr}), 'YYYY-MM-DD HH24:MI:SS.FF9')"
+	if data_type.startswith('TIMESTAMP'):
+		return f"TO_CHAR({expr}, 'YYYY-MM-DD HH24:MI:SS.FF9')"
+	if data_type in ('NUMBER', 'FLOAT', 'BINARY_FLOAT', 'BINARY_DOUBLE'):
+		return f"TO_CHAR({expr}, 'TM9', 'NLS_NUMERIC_CHARACTERS=''.,''')"
+	return expr
+
+#Типы столбцов (локальные имена) для hash_text_expr, у каждой БД свои
+def hash_column_types(columns_conf, columns, side):
+	if side == 'local':
+		column_types = columns_conf.get('column_types', {})
+		return [column_types.get(column) for column in columns]
+	column_types = {row['COLUMN_NAME'] : row for row in columns_conf.get('remote_dictionary', [])}
+	return [column_types.get(remote_column_name(columns_conf, column)) for column in columns]
+
+#Наибольшая длина столбца в байтах после hash_text_expr, тип неизвестен - считаем предельной
+def hash_text_width(column_type):
+	data_type = (column_type or {}).get('DATA_TYPE', '')
+	if data_type in ('VARCHAR2', 'CHAR'):
+		return int(column_type['DATA_LENGTH'])
+	if data_type in ('NVARCHAR2', 'NCHAR', 'RAW'):
+		return 2 * int(column_type['DATA_LENGTH'])
+	if data_type == 'DATE':
+		return 19
+	if data_type.startswith('TIMESTAMP'):
+		return 29
+	if data_type in ('NUMBER', 'FLOAT', 'BINARY_FLOAT', 'BINARY_DOUBLE'):
+		return 64
+	return 4000
+
+#Выражение для хэширования строки на стороне БД, не бывает NULL
+#Склейка значений не должна превысить 4000 байт (ORA-01489), для широких строк - MD5 каждого столбца, как в fingerprint_expr
+def key_hash_expr(key_columns, column_types=None):
+	column_types = column_types or [None] * len(key_columns)
+	if sum(hash_text_width(column_type) + 1 for column_type in column_types) + 1 > 4000:
+		return fingerprint_expr(key_columns, column_types)
+	return "'#'||"+"||'|'||".join(hash_text_expr(column, column_type) for column, column_type in zip(key_columns, column_types))
+
+#Номера бакетов ключа на каждом уровне дерева, уровни хэшируются с разным seed
+def bucket_exprs(expr, buckets, levels):
+	return [f"ORA_HASH({expr}, {buckets - 1}, {level})" for level in range(levels)]
+
+#Условие попадания строки в один из бакетов
+def buckets_filter(exprs, bucket_list):
+	values = ','.join('('+','.join(str(value) for value in bucket)+')' for bucket in bucket_list)
+	return f"({','.join(exprs)}) IN ({values})"
+
+#Кол-во строк и сумма хэшей ключей по бакетам, считается на стороне БД
+def get_bucket_checksums(engine, table, expr, exprs, bucket_list, condition=''):
+	conditions = []
+	if bucket_list != None:
+		conditions.append(buckets_filter(exprs[:-1], bucket_list))
+	if condition != '':
+		conditions.append(condition)
+	where = ''
+	if conditions:
+		where = 'WHERE '+' AND '.join(conditions)
+	answer = get_table_data(engine,
+							[f'{bucket} AS H{level}' for level, bucket in enumerate(exprs)] + ['COUNT(*) AS CNT', f'SUM(ORA_HASH({expr})) AS HSUM'],
+							table,
+							f"{where} GROUP BY {','.join(exprs)}")
+	if answer == None:
+		raise BaseException('Failed to calculate checksums for the table '+table)
+	return {tuple(row[f'H{level}'] for level in range(len(exprs))): (row['CNT'], row['HSUM']) for row in answer}
+
+#Сравнение по дереву контрольных сумм: построчно забираем только бакеты, суммы которых не совпали
+def checksum_compare(remote, local, columns, key_columns, buckets, levels):
+	remote_name = f"{remote['prefix']}{remote['name']}{remote['postfix']}"
+	local_name = f"{local['prefix']}{local['name']}{local['postfix']}"
+	remote_expr = key_hash_expr([remote_column_name(columns, column) for column in key_columns], hash_column_types(columns, key_columns, 'remote'))
+	local_expr = key_hash_expr(key_columns, hash_column_types(columns, key_columns, 'local'))
+	
+	mismatched = None
+	for level in range(1, levels + 1):
+		remote_exprs = bucket_exprs(remote_expr, buckets, level)
+		local_exprs = bucket_exprs(local_expr, buckets, level)
+		if mismatched == None:
+			chunks = [None]
+		else:
+			chunks = [mismatched[i:i + 1000] for i in range(0, len(mismatched), 1000)]
+		mismatched = []
+		mismatched_rows = 0
+		for chunk in chunks:
+			remote_sums = get_bucket_checksums(remote['engine'], remote_name, remote_expr, remote_exprs, chunk, remote.get('filter', ''))
+			local_sums = get_bucket_checksums(local['engine'], local_name, local_expr, local_exprs, chunk)
+			#Бакеты, которых нет в удаленной таблице, вставлять нечего
+			for bucket in remote_sums:
+				if remote_sums[bucket] != local_sums.get(bucket):
+					mismatched.append(bucket)
+					mismatched_rows += remote_sums[bucket][0]
+		logging.debug(f'Checksum level {level}: {len(mismatched)} mismatched buckets, {mismatched_rows} remote rows')
+		if mismatched == []:
+			return
+		#Дальше дробить нет смысла, строк уже меньше, чем бакетов
+		if mismatched_rows <= buckets:
+			break
+	
+	remote_exprs = bucket_exprs(remote_expr, buckets, len(mismatched[0]))
+	local_exprs = bucket_exprs(local_expr, buckets, len(mismatched[0]))
+	for i in range(0, len(mismatched), 1000):
+		chunk = mismatched[i:i + 1000]
+		local_keys = set()
+		for row in get_big_table_data(local['engine'], key_columns, local_name, 'WHERE '+buckets_filter(local_exprs, chunk)):
+			local_keys.add(tuple(row))
+		for row in get_big_table_data(remote['engine'], map_columns(columns), remote_name, 'WHERE '+buckets_filter(remote_exprs, chunk)+remote_filter(remote, ' AND')):
+			if tuple(getattr(row, key) for key in key_columns) not in local_keys:
+				yield row
+
+#Столбцы первичного ключа таблицы
+def get_primary_key(table_conf):
+	answer = get_table_data(table_conf['engine'],
+							['cc.column_name'],
+							f"all_constraints{table_conf['postfix']} c JOIN all_cons_columns{table_conf['postfix']} cc ON cc.owner = c.owner AND cc.constraint_name = c.constraint_name",
+							f"WHERE c.constraint_type = 'P' AND c.table_name = '{table_conf['name']}' AND {owner_condition(table_conf, 'c.owner')} ORDER BY cc.position")
+	if answer == None:
+		return None
+	return [row['COLUMN_NAME'] for row in answer]
+
+#Отпечаток строки на стороне БД: MD5 каждого столбца, хэши склеиваются группами, чтобы строка не превысила 4000 байт
+def fingerprint_expr(columns, column_types):
+	exprs = [f"STANDARD_HASH('#'||{hash_text_expr(column, column_type)}, 'MD5')" for column, column_type in zip(columns, column_types)]
+	while len(exprs) > 1:
+		exprs = [f"STANDARD_HASH({'||'.join(exprs[i:i + 100])}, 'MD5')" for i in range(0, len(exprs), 100)]
+	return exprs[0]
+
+#Условие выборки строк по списку ключей: IN по 1000 ключей, ключи с NULL - отдельными условиями
+def keys_condition(key_exprs, keys):
+	conditions = []
+	full = [key for key in keys if None not in key]
+	for i in range(0, len(full), 1000):
+		if len(key_exprs) == 1:
+			conditions.append(f"{key_exprs[0]} IN ({','.join(sql_literal(key[0]) for key in full[i:i + 1000])})")
+		else:
+			conditions.append(f"({','.join(key_exprs)}) IN ({','.join('('+','.join(sql_literal(value) for value in key)+')' for key in full[i:i + 1000])})")
+	for key in keys:
+		if None in key:
+			conditions.append('('+' AND '.join(f'{expr} IS NULL' if value == None else f'{expr} = {sql_literal(value)}' for expr, value in zip(key_exprs, key))+')')
+	return '('+' OR '.join(conditions)+')'
+
+#Сравнение по отпечаткам: из обеих БД забираем только ключ и хэш остальных столбцов, целиком читаем только строки недостающих ключей
+#С diff_key сравниваются только ключи, без него ключом служит первичный ключ локальной таблицы
+#diff только вставляет, поэтому изменившиеся строки (ключ есть, хэш другой) не возвращаются, а только подсчитываются
+def fingerprint_compare(remote, local, columns, lookup_keys):
+	remote_name = f"{remote['prefix']}{remote['name']}{remote['postfix']}"
+	local_name = f"{local['prefix']}{local['name']}{local['postfix']}"
+	column_types = columns.get('column_types', {})
+	if 'diff_key' in columns:
+		key_columns = list(columns['diff_key'])
+		hash_columns = []
+	else:
+		key_columns = get_primary_key(local)
+		if key_columns == None:
+			raise BaseException('Failed to get the primary key of the table '+local_name)
+		if key_columns == []:
+			raise BaseException('diff_method fingerprint needs diff_key or a primary key in the table '+local_name)
+		hash_columns = [column for column in columns['local_columns'] if (column not in key_columns)
+						and ((column not in column_types) or (column_types[column]['DATA_TYPE'] not in lob_types))]
+	remote_key_exprs = [remote_column_name(columns, column) for column in key_columns]
+	local_select = list(key_columns)
+	remote_select = [expr if expr == column else f"{expr} AS {column}" for expr, column in zip(remote_key_exprs, key_columns)]
+	if hash_columns:
+		local_select.append(f"{fingerprint_expr(hash_columns, hash_column_types(columns, hash_columns, 'local'))} AS DBSYNC_FP")
+		remote_select.append(f"{fingerprint_expr([remote_column_name(columns, column) for column in hash_columns], hash_column_types(columns, hash_columns, 'remote'))} AS DBSYNC_FP")
+	
+	#Ключ -> отпечаток (без хэша - None)
+	local_rows = {}
+	for row in get_big_table_data(local['engine'], local_select, local_name):
+		local_rows[tuple(row)[:len(key_columns)]] = row[-1] if hash_columns else None
+	missing = {}
+	skipped = 0
+	changed = 0
+	for row in get_big_table_data(remote['engine'], remote_select, remote_name, remote_filter(remote, 'WHERE')):
+		key = tuple(row)[:len(key_columns)]
+		if key not in local_rows:
+			missing[key] = True
+		elif hash_columns and (local_rows[key] != row[-1]):
+			changed += 1
+		else:
+			skipped += 1
+	add_metric('rows_skipped', skipped + changed)
+	local_rows = None
+	if changed:
+		logging.warning(f' {changed} rows of the table {local_name} differ from the remote table, sync_type diff does not update them (use sync_type merge)')
+	logging.debug(f'Fingerprint diff: {len(missing)} keys are missing in the table {local_name}')
+	if not missing:
+		return
+	
+	#Много ключей дешевле отфильтровать за один проход по удаленной таблице, чем искать списками
+	if len(missing) > lookup_keys:
+		for row in get_big_table_data(remote['engine'], map_columns(columns), remote_name, remote_filter(remote, 'WHERE')):
+			if tuple(getattr(row, column) for column in key_columns) in missing:
+				yield row
+		return
+	keys = list(missing)
+	for i in range(0, len(keys), 1000):
+		for row in get_big_table_data(remote['engine'], map_columns(columns), remote_name,
+									'WHERE '+keys_condition(remote_key_exprs, keys[i:i + 1000])+remote_filter(remote, ' AND')):
+			yield row
+
+#Условие совпадения ключа локальной строки (l) с выражениями удаленной, NULL равен NULL как в MINUS
+#Для NOT NULL столбцов обычное равенство, чтобы БД могла использовать индексы и hash join
+def key_match_condition(columns_conf, key_columns, remote_exprs):
+	conditions = []
+	for column, remote_expr in zip(key_columns, remote_exprs):
+		if column in columns_conf['nullable_columns']:
+			conditions.append(f"(l.{column} = {remote_expr} OR (l.{column} IS NULL AND {remote_expr} IS NULL))")
+		else:
+			conditions.append(f"l.{column} = {remote_expr}")
+	return ' AND '.join(conditions)
+
+#Условие изменения неключевых столбцов строки l относительно r, NULL равен NULL
+#DECODE и = на LOB дают ORA-00932, их сравниваем через DBMS_LOB.COMPARE (NULL, если хоть одно значение NULL)
+def columns_changed_condition(columns_conf, update_columns):
+	column_types = columns_conf.get('column_types', {})
+	conditions = []
+	for column in update_columns:
+		if (column in column_types) and (column_types[column]['DATA_TYPE'] in lob_types):
+			conditions.append(f"DBMS_LOB.COMPARE(l.{column}, r.{column}) <> 0 OR (l.{column} IS NULL AND r.{column} IS NOT NULL) OR (l.{column} IS NOT NULL AND r.{column} IS NULL)")
+		else:
+			conditions.append(f"DECODE(l.{column}, r.{column}, 0, 1) = 1")
+	return ' OR '.join(conditions)
+
+#Ветки MERGE: обновление изменившихся неключевых столбцов и вставка новых строк
+def merge_clauses(columns_conf, key_columns):
+	update_columns = [column for column in columns_conf['local_columns'] if column not in key_columns]
+	clauses = ''
+	if update_columns:
+		clauses += (f"WHEN MATCHED THEN UPDATE SET {', '.join(f'l.{column} = r.{column}' for column in update_columns)} "
+					f"WHERE {columns_changed_condition(columns_conf, update_columns)} ")
+	clauses += (f"WHEN NOT MATCHED THEN INSERT ({','.join(columns_conf['local_columns'])}) "
+				f"VALUES ({','.join('r.'+column for column in columns_conf['local_columns'])})")
+	return clauses
+
+#Запрос строк удаленной таблицы, ключей которых нет в локальной (обе таблицы доступны из одной БД)
+def missing_rows_query(columns_conf, local_conf, remote_conf, condition=''):
+	key_columns, remote_columns = get_key_columns(columns_conf)
+	return (f"SELECT {','.join(remote_select_columns(columns_conf, 'r.'))} "
+			f"FROM {remote_conf['prefix']}{remote_conf['name']}{remote_conf['postfix']} r "
+			f"WHERE NOT EXISTS (SELECT 1 FROM {local_conf['prefix']}{local_conf['name']}{local_conf['postfix']} l "
+			f"WHERE {key_match_condition(columns_conf, key_columns, ['r.'+remote_column_name(columns_conf, column) for column in key_columns])}) "
+			f"{remote_filter(remote_conf, 'AND')} {condition}")
+
+#Вставка недостающих строк целиком на стороне БД, данные не покидают сервер
+def server_diff_insert(columns_conf, local_conf, remote_conf, chunks=1):
+	conditions = ['']
+	#Для огромных таблиц режем выборку по хэшу ключа и коммитим каждую часть отдельно
+	if chunks > 1:
+		key_columns, remote_columns = get_key_columns(columns_conf)
+		key_expr = key_hash_expr(['r.'+remote_column_name(columns_conf, column) for column in key_columns], hash_column_types(columns_conf, key_columns, 'remote'))
+		conditions = [f"AND ORA_HASH({key_expr}, {chunks - 1}) = {chunk}" for chunk in range(chunks)]
+	for condition in conditions:
+		query = (f"INSERT /*+ APPEND */ INTO {local_conf['prefix']}{local_conf['name']}{local_conf['postfix']} "
+				f"({','.join(columns_conf['local_columns'])}) "
+				+ missing_rows_query(columns_conf, local_conf, remote_conf, condition))
+		if exec_query(local_conf['engine'], query) == None:
+			return None
+	return True
+
+#Кол-во недостающих строк, считается на стороне БД
+def server_diff_count(columns_conf, local_conf, remote_conf):
+	answer = get_table_data(local_conf['engine'],
+							['COUNT(*) AS CNT'],
+							f"({missing_rows_query(columns_conf, local_conf, remote_conf)})")
+	if answer == None:
+		return None
+	return answer[0]['CNT']
+
+#Диапазоны ROWID по экстентам таблицы, разбитым на части примерно одинакового размера в блоках
+#Внутри части экстенты одного объекта (секции) идут подряд, поэтому на объект хватает одного диапазона
+def rowid_conditions(remote_conf, chunks):
+	answer = get_table_data(remote_conf['engine'],
+							['o.data_object_id', 'e.relative_fno', 'e.block_id', 'e.blocks',
+							'DBMS_ROWID.ROWID_CREATE(1, o.data_object_id, e.relative_fno, e.block_id, 0) AS first_rowid',
+							'DBMS_ROWID.ROWID_CREATE(1, o.data_object_id, e.relative_fno, e.block_id + e.blocks - 1, 32767) AS last_rowid'],
+							f"dba_extents{remote_conf['postfix']} e JOIN all_objects{remote_conf['postfix']} o "
+							"ON o.owner = e.owner AND o.object_name = e.segment_name AND o.object_type LIKE 'TABLE%' "
+							"AND DECODE(o.subobject_name, e.partition_name, 1, 0) = 1",
+							f"WHERE e.segment_name = '{remote_conf['name']}' AND {owner_condition(remote_conf, 'e.owner')} "
+							"AND e.segment_type IN ('TABLE', 'TABLE PARTITION', 'TABLE SUBPARTITION') "
+							"ORDER BY o.data_object_id, e.relative_fno, e.block_id")
+	if answer == None:
+		return None
+	if answer == []:
+		return ['1 = 1']
+	total = sum(row['BLOCKS'] for row in answer)
+	ranges = {}
+	passed = 0
+	for row in answer:
+		chunk = min(chunks - 1, passed * chunks // total)
+		passed += row['BLOCKS']
+		if (chunk, row['DATA_OBJECT_ID']) not in ranges:
+			ranges[(chunk, row['DATA_OBJECT_ID'])] = [row['FIRST_ROWID'], row['LAST_ROWID']]
+		ranges[(chunk, row['DATA_OBJECT_ID'])][1] = row['LAST_ROWID']
+	conditions = {}
+	for (chunk, object_id), (first, last) in ranges.items():
+		conditions.setdefault(chunk, []).append(f"ROWID BETWEEN CHARTOROWID('{first}') AND CHARTOROWID('{last}')")
+	return [' OR '.join(conditions[chunk]) for chunk in sorted(conditions)]
+
+#Диапазоны значений числового столбца между его минимумом и максимумом, NULL попадают в первую часть
+def range_conditions(remote_conf, column, chunks):
+	answer = get_table_data(remote_conf['engine'],
+							[f'MIN({column}) AS min_value', f'MAX({column}) AS max_value'],
+							remote_conf['prefix']+remote_conf['name']+remote_conf['postfix'],
+							remote_filter(remote_conf, 'WHERE'))
+	if answer == None:
+		return None
+	low, high = answer[0]['MIN_VALUE'], answer[0]['MAX_VALUE']
+	if low == None:
+		return ['1 = 1']
+	if not isinstance(low, (int, float, Decimal)):
+		logging.error(f' split_method range needs a numeric split_column, {column} is not')
+		return None
+	if isinstance(low, int) and isinstance(high, int):
+		bounds = [low + (high - low + 1) * chunk // chunks for chunk in range(chunks)]
+	else:
+		bounds = [low + (high - low) * chunk / chunks for chunk in range(chunks)]
+	bounds = sorted(set(bounds))
+	conditions = []
+	for i, bound in enumerate(bounds):
+		condition = f"{column} >= {sql_literal(bound)}"
+		if i + 1 < len(bounds):
+			condition += f" AND {column} < {sql_literal(bounds[i + 1])}"
+		if i == 0:
+			condition = f"{column} IS NULL OR {condition}"
+		conditions.append(condition)
+	return conditions
+
+#Условия на части удаленной таблицы для параллельной выгрузки (split)
+def split_conditions(columns_conf, remote_conf, split_conf):
+	if split_conf['column'] != None:
+		if isinstance(split_conf['column'], str):
+			split_columns = [split_conf['column']]
+		else:
+			split_columns = list(split_conf['column'])
 	else:
-		key_columns = tuple(columns['local_columns'])
-		remote_columns = tuple(columns['local_columns'])
+		split_columns = list(get_key_columns(columns_conf)[0])
+	split_types = hash_column_types(columns_conf, split_columns, 'remote')
+	split_columns = [remote_column_name(columns_conf, column) for column in split_columns]
+	
+	if split_conf['method'] == 'rowid':
+		return rowid_conditions(remote_conf, split_conf['chunks'])
+	if split_conf['method'] == 'range':
+		if len(split_columns) != 1:
+			logging.error(' split_method range needs exactly one split_column')
+			return None
+		return range_conditions(remote_conf, split_columns[0], split_conf['chunks'])
+	if split_conf['method'] == 'hash':
+		key_expr = key_hash_expr(split_columns, split_types)
+		return [f"ORA_HASH({key_expr}, {split_conf['chunks'] - 1}) = {chunk}" for chunk in range(split_conf['chunks'])]
+	logging.error(f" Unknown split_method {split_conf['method']}")
+	return None
+
+#Сравнение таблиц
+def compare_tables(remote, local, columns, one_db, diff_conf={'method': 'set'}):
+	key_columns, remote_columns = get_key_columns(columns)
 	if one_db:
-		minus_query = f"{local['prefix']}{local['name']}{local['postfix']} MINUS SELECT {','.join(remote_columns)} FROM {remote['prefix']}{remote['name']}{remote['postfix']}"
-		minus_result = get_big_table_data(local['engine'], key_columns, minus_query)
-		for row in minus_result:
+		query = missing_rows_query(columns, local, remote)
+		for row in get_big_table_data(local['engine'], ['*'], f"({query})"):
+			yield row
+	elif diff_conf['method'] == 'merge':
+		#Обе стороны читаем отсортированными по ключу, удаленную - по исходным именам столбцов
+		remote_data = get_big_table_data(remote['engine'],
+										map_columns(columns),
+										f"{remote['prefix']}{remote['name']}{remote['postfix']}",
+										remote_filter(remote, 'WHERE')+' '+key_order_clause([remote_column_name(columns, column) for column in key_columns]))
+		local_data = get_big_table_data(local['engine'],
+										key_columns,
+										f"{local['prefix']}{local['name']}{local['postfix']}",
+										key_order_clause(key_columns))
+		for row in merge_compare(remote_data, local_data, key_columns):
+			yield row
+	elif diff_conf['method'] == 'checksum':
+		for row in checksum_compare(remote, local, columns, key_columns, diff_conf['buckets'], diff_conf['levels']):
+			yield row
+	elif diff_conf['method'] == 'fingerprint':
+		for row in fingerprint_compare(remote, local, columns, diff_conf['lookup_keys']):
+			yield row
+	elif diff_conf.get('key_index', 'set') == 'hash':
+		for row in key_index_compare(remote, local, key_columns, diff_conf.get('key_index_verify', False)):
 			yield row
 	else:
 		local_keys = set()
@@ -383,11 +1931,128 @@ def compare_tables(remote, local, columns, one_db):
 		for row in local['data']:
 			local_keys.add(tuple(getattr(row, key) for key in key_columns))
 	
+		skipped = 0
 		for row in remote['data']:
 			key = tuple(getattr(row, key) for key in key_columns)
 		
 			if key not in local_keys:
 				yield row
+			else:
+				skipped += 1
+		add_metric('rows_skipped', skipped)
+
+#64-битный хэш ключа; числа приводим к одному виду, чтобы 5, 5.0 и Decimal('5') совпадали, как в множестве
+def key_hash64(key):
+	key = tuple(Decimal(value).normalize() if isinstance(value, (int, float, Decimal)) else value for value in key)
+	return int.from_bytes(hashlib.blake2b(repr(key).encode(), digest_size=8).digest(), 'little', signed=True)
+
+#Компактный индекс ключей: отсортированный массив 64-битных хэшей, 8 байт на строку вместо кортежа объектов
+def build_key_index(rows, key_columns):
+	hashes = array('q')
+	for row in rows:
+		hashes.append(key_hash64(tuple(getattr(row, key) for key in key_columns)))
+	if numpy != None:
+		index = numpy.frombuffer(hashes, dtype=numpy.int64).copy()
+		del hashes
+		index.sort()
+		return index
+	return array('q', sorted(hashes))
+
+#Есть ли хэши в индексе: бинарный поиск пачкой, с NumPy - векторный
+def key_index_contains(index, hashes):
+	if len(index) == 0:
+		return [False] * len(hashes)
+	if numpy != None:
+		values = numpy.array(hashes, dtype=numpy.int64)
+		positions = numpy.minimum(numpy.searchsorted(index, values), len(index) - 1)
+		return (index[positions] == values).tolist()
+	result = []
+	for value in hashes:
+		position = bisect_left(index, value)
+		result.append((position < len(index)) and (index[position] == value))
+	return result
+
+#Ключи из списка, которые действительно есть в локальной таблице
+def local_keys_present(local, key_columns, keys):
+	present = set()
+	for i in range(0, len(keys), 1000):
+		for row in get_big_table_data(local['engine'], key_columns, f"{local['prefix']}{local['name']}{local['postfix']}",
+									'WHERE '+keys_condition(key_columns, keys[i:i + 1000])):
+			present.add(tuple(row))
+	return present
+
+#Сравнение через компактный индекс хэшей ключей; совпадение хэша при verify перепроверяется по локальной таблице
+#Без проверки совпадение 64-битных хэшей разных ключей молча пропустит недостающую строку: вероятность не больше N*M/2^64
+#(N локальных ключей, M недостающих), проверка же стоит запроса к локальной таблице на каждые 1000 найденных ключей
+def key_index_compare(remote, local, key_columns, verify):
+	index = build_key_index(local['data'], key_columns)
+	logging.debug(f"Key index of the table {local['name']}: {len(index)} keys, {len(index) * 8} bytes")
+	skipped = 0
+	for batch in batched(remote['data'], 2000):
+		keys = [tuple(getattr(row, key) for key in key_columns) for row in batch]
+		found = key_index_contains(index, [key_hash64(key) for key in keys])
+		if verify:
+			present = local_keys_present(local, list(key_columns), [key for key, hit in zip(keys, found) if hit])
+			found = [hit and (key in present) for key, hit in zip(keys, found)]
+		for row, hit in zip(batch, found):
+			if hit:
+				skipped += 1
+			else:
+				yield row
+	add_metric('rows_skipped', skipped)
+
+#Значения, которые json не умеет хранить сам
+def encode_state_value(value):
+	if isinstance(value, datetime):
+		return {'datetime' : value.isoformat()}
+	if isinstance(value, Decimal):
+		return {'decimal' : str(value)}
+	raise TypeError(f'Unsupported state value {value!r}')
+
+def decode_state_value(value):
+	if list(value.keys()) == ['datetime']:
+		return datetime.fromisoformat(value['datetime'])
+	if list(value.keys()) == ['decimal']:
+		return Decimal(value['decimal'])
+	return value
+
+def read_state_file(config):
+	try:
+		with open(config.get('state_file', './dbSync.state'), encoding='utf-8') as f:
+			return json.load(f, object_hook=decode_state_value)
+	except FileNotFoundError:
+		return {}
+
+#Чтение сохраненного состояния таблицы
+def load_state(config, key):
+	with state_lock:
+		try:
+			return read_state_file(config).get(key, {})
+		except BaseException as e:
+			logging.error('Failed to read the state file')
+			logging.error(str(e))
+			return None
+
+#Сохранение состояния таблицы, None удаляет значение. Пишем через временный файл, чтобы не потерять состояние при сбое
+def save_state(config, key, values):
+	filename = config.get('state_file', './dbSync.state')
+	with state_lock:
+		try:
+			state = read_state_file(config)
+			table_state = state.setdefault(key, {})
+			for name, value in values.items():
+				if value == None:
+					table_state.pop(name, None)
+				else:
+					table_state[name] = value
+			with open(filename+'.tmp', 'w', encoding='utf-8') as f:
+				json.dump(state, f, default=encode_state_value, indent=1)
+			os.replace(filename+'.tmp', filename)
+			return True
+		except BaseException as e:
+			logging.error('Failed to save the state file '+filename)
+			logging.error(str(e))
+			return None
 
 #Удаление старых файлов	
 def delete_old_backups(tablename, deadline, config):
@@ -402,150 +2067,1014 @@ def delete_old_backups(tablename, deadline, config):
 	dead_date = datetime.now() - timedelta(days=deadline)
 	
 	for f in files:
-		file_date = datetime.strptime(f, "%Y-%m-%d_%H%M%S")
+		#Имя файла - дата, у сжатых бэкапов еще и расширение
+		try:
+			file_date = datetime.strptime(f.split('.')[0], "%Y-%m-%d_%H%M%S")
+		except ValueError:
+			continue
 		if file_date < dead_date:
 			os.remove(filename+f)
 
 #Создание нехватающих локальних директорий
 def check_local_path(path):
-	exists_path = '.'
-	for path_part in path.split('/')[1:-1]:
-		exists_path += '/'+path_part
-		if not (os.path.exists(exists_path)):
-			os.mkdir(exists_path)
+	os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
 			
-#Создание csv файла с данными
-def make_csv(data, tablename, config):
-	if 'backup_path' in config:
-		filename = config['backup_path']+'/'+tablename+'/'+datetime.now().strftime("%Y-%m-%d_%H%M%S")
-	else:
-		filename = './backup'+'/'+tablename+'/'+datetime.now().strftime("%Y-%m-%d_%H%M%S")
-	check_local_path(filename)
+#Открытие файла бэкапа с потоковым сжатием
+def open_backup_file(backup):
+	if backup['compress'] == 'gzip':
+		return gzip.open(backup['filename'], 'wt', compresslevel=backup['level'], newline='', encoding='utf-8')
+	if backup['compress'] == 'zstd':
+		return zstandard.open(backup['filename'], 'wt', cctx=zstandard.ZstdCompressor(level=backup['level']), newline='', encoding='utf-8')
+	return open(backup['filename'], 'w', newline='', encoding='utf-8')
+
+#Подготовка бэкапа таблицы, файл пишется фоновым потоком по мере чтения строк
+def open_backup(tablename, config, backup_conf=None):
+	backup_conf = backup_conf or {}
+	backup = {'compress' : backup_conf.get('compress', 'none'),
+			'level' : int(backup_conf.get('level', 6)),
+			'column_types' : backup_conf.get('column_types', {}),
+			'queue' : queue.Queue(maxsize=8),
+			'thread' : None,
+			'errors' : [],
+			'complete' : False}
+	if (backup['compress'] == 'zstd') and (zstandard == None):
+		logging.warning('The zstandard module is not installed, gzip is used for backups')
+		backup['compress'] = 'gzip'
+	extension = {'gzip' : '.gz', 'zstd' : '.zst'}.get(backup['compress'], '')
+	backup['filename'] = config.get('backup_path', './backup')+'/'+tablename+'/'+datetime.now().strftime("%Y-%m-%d_%H%M%S")+extension
+	check_local_path(backup['filename'])
+	return backup
+
+#Строка с большими LOB пишется по полям: значение LOB переносится из временного файла частями
+def write_lob_row(f, row, binary):
+	for i, value in enumerate(row):
+		if i > 0:
+			f.write(';')
+		if isinstance(value, tempfile.SpooledTemporaryFile):
+			if i in binary:
+				for piece in lob_pieces(value):
+					f.write(piece.hex())
+			else:
+				f.write('"')
+				for piece in lob_pieces(value):
+					f.write(piece.replace('"', '""'))
+				f.write('"')
+		else:
+			field = io.StringIO()
+			csv.writer(field, delimiter=';').writerow([value.hex() if (i in binary) and (value != None) else value])
+			f.write(field.getvalue().rstrip('\r\n'))
+	f.write('\r\n')
+
+#Фоновая запись пачек строк из очереди в файл
+def backup_writer(backup):
 	try:
-		with open(filename, "w", newline="", encoding="utf-8") as f:
+		with open_backup_file(backup) as f:
 			writer = csv.writer(
 				f,
 				delimiter=";"
 			)
 			first_row = True
-			for row in data:
+			while True:
+				batch = backup['queue'].get()
+				if batch == None:
+					break
+				started = time.monotonic()
 				if first_row:
-					writer.writerow(row._fields)
+					#В заголовке рядом с именем столбца пишем его тип, чтобы при восстановлении не полагаться на неявное приведение строк
+					column_types = backup['column_types']
+					writer.writerow(f"{field}:{format_data_type(column_types[field])}" if field in column_types else field
+									for field in batch[0]._fields)
+					binary = [i for i, field in enumerate(batch[0]._fields)
+								if (field in column_types) and (column_types[field]['DATA_TYPE'] in ('RAW', 'BLOB', 'LONG RAW'))]
+					lobs = [i for i, field in enumerate(batch[0]._fields)
+							if (field in column_types) and (column_types[field]['DATA_TYPE'] in lob_types)]
 				first_row = False
-				
-				writer.writerow(row)
-				
+				if lobs:
+					for row in batch:
+						if any(isinstance(row[i], tempfile.SpooledTemporaryFile) for i in lobs):
+							write_lob_row(f, row, binary)
+						else:
+							writer.writerow([value.hex() if (i in binary) and (value != None) else value for i, value in enumerate(row)])
+					add_phase_time('backup', started)
+					continue
+				#Двоичные данные пишем в hex
+				if binary:
+					batch = [[value.hex() if (i in binary) and (value != None) else value for i, value in enumerate(row)] for row in batch]
+				writer.writerows(batch)
+				add_phase_time('backup', started)
+	except BaseException as e:
+		backup['errors'].append(e)
+		#Разбираем очередь до конца, чтобы не блокировать поток синхронизации
+		while backup['queue'].get() != None:
+			pass
+	#Недописанный бэкап хуже, чем никакого - в т.ч. если запись упала уже после чтения всех строк
+	if (backup['errors'] or (not backup['complete'])) and os.path.exists(backup['filename']):
+		os.remove(backup['filename'])
+
+def put_backup_batch(backup, batch):
+	if backup['thread'] == None:
+		backup['thread'] = context_thread(backup_writer, backup)
+		backup['thread'].start()
+	backup['queue'].put(batch)
+
+#Строки проходят дальше без изменений, а их копия уходит в бэкап - таблица читается один раз
+def backup_tee(rows, backup):
+	batch = []
+	try:
+		for row in rows:
+			batch.append(row)
+			if len(batch) >= 1000:
+				put_backup_batch(backup, batch)
+				batch = []
+			yield row
+		if batch:
+			put_backup_batch(backup, batch)
+		backup['complete'] = True
+	finally:
+		if backup['thread'] != None:
+			backup['queue'].put(None)
+
+#Ожидание записи бэкапа, возвращает имя файла или None
+def close_backup(backup):
+	if backup['thread'] != None:
+		backup['thread'].join()
+	elif backup['complete']:
+		#Пустая таблица - файл все равно создаем, как и раньше
+		backup['queue'].put(None)
+		backup_writer(backup)
+	if backup['errors']:
+		logging.error('Возникла ошибка при создании csv файла '+backup['filename'])
+		logging.error(str(backup['errors'][0]))
+	if backup['errors'] or (not backup['complete']):
+		return None
+	return backup['filename']
+
+#Создание csv файла с данными
+def make_csv(data, tablename, config, backup_conf=None):
+	backup = open_backup(tablename, config, backup_conf)
+	try:
+		for row in backup_tee(data, backup):
+			pass
 	except BaseException as e:
-		logging.error('Возникла ошибка при создании csv файла '+filename)
+		logging.error('Возникла ошибка при создании csv файла '+backup['filename'])
 		logging.error(str(e))
-		filename = None
+	return close_backup(backup)
 	
-	return filename
+#Выбор файла бэкапа: последний, сделанный не позже указанного времени
+def find_backup(tablename, config, at=None):
+	path = config.get('backup_path', './backup')+'/'+tablename+'/'
+	candidates = []
+	for f in os.listdir(path):
+		try:
+			file_date = datetime.strptime(f.split('.')[0], "%Y-%m-%d_%H%M%S")
+		except ValueError:
+			continue
+		if (at == None) or (file_date <= at):
+			candidates.append((file_date, f))
+	if candidates == []:
+		return None
+	return path+max(candidates)[1]
+
+def read_backup_file(filename):
+	if filename.endswith('.gz'):
+		return gzip.open(filename, 'rt', newline='', encoding='utf-8')
+	if filename.endswith('.zst'):
+		return zstandard.open(filename, 'rt', newline='', encoding='utf-8')
+	return open(filename, newline='', encoding='utf-8')
+
+#Столбцы и их типы из заголовка бэкапа, в старых бэкапах типов нет
+def parse_backup_header(header):
+	columns = []
+	column_types = {}
+	for field in header:
+		name, _, data_type = field.partition(':')
+		columns.append(name)
+		if data_type == '':
+			continue
+		sized = re.fullmatch(r'([A-Z0-9_ ]+)\((\d+)(?:,-?\d+)?\)', data_type)
+		if sized:
+			column_types[name] = {'DATA_TYPE' : sized.group(1), 'DATA_LENGTH' : sized.group(2)}
+		else:
+			column_types[name] = {'DATA_TYPE' : data_type, 'DATA_LENGTH' : None}
+	return columns, column_types
+
+#Значение из csv в тип столбца
+def parse_backup_value(value, column):
+	if value == '':
+		return None
+	if column == None:
+		return value
+	data_type = column['DATA_TYPE']
+	if data_type in ('NUMBER', 'FLOAT'):
+		return Decimal(value)
+	if data_type in ('BINARY_DOUBLE', 'BINARY_FLOAT'):
+		return float(value)
+	if (data_type == 'DATE') or data_type.startswith('TIMESTAMP'):
+		return datetime.fromisoformat(value)
+	if data_type in ('RAW', 'BLOB', 'LONG RAW'):
+		return bytes.fromhex(value)
+	return value
+
+#Состояние процесса, восстанавливающего части бэкапа
+restore_worker = {}
+
+def init_restore_worker(conn_conf, pool_conf, general_config, log_level, table, columns, column_types):
+	setup_logging({'General' : general_config}, log_level)
+	restore_worker['engine'] = get_db_connection(conn_conf, pool_conf)
+	restore_worker['table'] = table
+	restore_worker['columns'] = columns
+	restore_worker['column_types'] = column_types
+	restore_worker['row'] = namedtuple('Row', columns)
+
+#Разбор и загрузка части бэкапа в отдельном процессе, каждая часть коммитится сама
+def restore_chunk(lines):
+	columns = restore_worker['columns']
+	column_types = [restore_worker['column_types'].get(column) for column in columns]
+	Row = restore_worker['row']
+	rows = [Row(*[parse_backup_value(value, column) for value, column in zip(line, column_types)]) for line in lines]
+	answer = insert_table_data(restore_worker['engine'],
+								columns,
+								restore_worker['table'],
+								rows,
+								{'bulk_load' : True, 'column_types' : restore_worker['column_types']})
+	if answer == None:
+		return None
+	return len(rows)
+
+#Восстановление таблицы из бэкапа: файл читается по частям, части разбираются и грузятся параллельно в нескольких процессах
+def restore_table(yml_config, tablename, at, conn_name, workers):
+	general_config = yml_config['General']
+	filename = find_backup(tablename, general_config, at)
+	if filename == None:
+		logging.error(' No backup found for the table '+tablename)
+		return False
+	conn_conf = replace_connects({'local_db' : conn_name, 'remote_db' : conn_name}, yml_config['Connections'])['local_db']
+	pool_conf = get_pool_conf(general_config)
+	engine = get_db_connection(conn_conf, pool_conf)
+	if engine == None:
+		logging.critical(' Failed to establish a connection to the database '+conn_name)
+		return False
+	table = f"{conn_conf['scheme_name']}{tablename}{conn_conf['postfix']}"
+	logging.info(f' Restoring the table {table} from {filename}')
+	
+	restored = 0
+	failed = False
+	#Значения LOB в бэкапе могут быть больше стандартного ограничения поля
+	csv.field_size_limit(sys.maxsize)
+	with read_backup_file(filename) as f:
+		reader = csv.reader(f, delimiter=';')
+		header = next(reader, None)
+		if exec_query(engine, f"TRUNCATE TABLE {table}") == None:
+			return False
+		if header == None:
+			logging.info(f' The backup is empty, the table {table} was truncated')
+			return True
+		columns, column_types = parse_backup_header(header)
+		#Процессы запускаем с нуля: унаследованные через fork сессии пула использовать нельзя
+		with ProcessPoolExecutor(max_workers=workers,
+								mp_context=multiprocessing.get_context('spawn'),
+								initializer=init_restore_worker,
+								initargs=(conn_conf, pool_conf, general_config, logging.getLevelName(logging.getLogger().level),
+										table, columns, column_types)) as executor:
+			futures = set()
+			for chunk in batched(reader, int(general_config.get('restore_chunk', 50000))):
+				futures.add(executor.submit(restore_chunk, chunk))
+				#Не читаем файл сильно быстрее, чем успевают загружать
+				if len(futures) >= workers * 2:
+					done, futures = wait(futures, return_when=FIRST_COMPLETED)
+					for future in done:
+						if future.result() == None:
+							failed = True
+						else:
+							restored += future.result()
+				if failed:
+					break
+			for future in futures:
+				if future.result() == None:
+					failed = True
+				else:
+					restored += future.result()
+	if failed:
+		logging.error(f' Failed to restore the table {table}, {restored} lines were loaded')
+		return False
+	logging.info(f' Restored {restored} lines into the table {table}')
+	return True
+
+#Значение параметра: таблица -> задача -> General -> по умолчанию
+def get_option(option, table, sync_conf, general_config, default=None):
+	for conf in (table, sync_conf, general_config):
+		if option in conf:
+			return conf[option]
+	return default
+
+#Дочитываем строки в бэкап (если их еще никто не прочитал), ждем записи и чистим старые файлы
+def finish_backup(backup, local_conf, sync_conf, general_config):
+	try:
+		for row in local_conf['data']:
+			pass
+	except BaseException as e:
+		logging.error('Возникла ошибка при создании csv файла '+backup['filename'])
+		logging.error(str(e))
+	backup_result = close_backup(backup)
+	if ('rotate' in sync_conf):
+		delete_old_backups(local_conf['name'], sync_conf['rotate'], general_config)
+	return backup_result
+
+#Ограничиваем выгрузку строками между сохраненным водяным знаком и текущим максимумом
+#Максимум фиксируем заранее, чтобы строки, вставленные во время синхронизации, попали в следующий запуск
+def set_watermark_filter(incremental_column, columns_conf, remote_conf, general_config, state_key):
+	state = load_state(general_config, state_key)
+	if state == None:
+		return None
+	remote_name = remote_column_name(columns_conf, incremental_column)
+	answer = get_table_data(remote_conf['engine'],
+							[f'MAX({remote_name}) AS HWM'],
+							remote_conf['prefix']+remote_conf['name']+remote_conf['postfix'])
+	if answer == None:
+		return None
+	remote_conf['last_watermark'] = state.get('watermark')
+	remote_conf['watermark'] = answer[0]['HWM']
+	conditions = [f"{remote_name} <= {sql_literal(remote_conf['watermark'])}"]
+	if remote_conf['last_watermark'] != None:
+		conditions.insert(0, f"{remote_name} > {sql_literal(remote_conf['last_watermark'])}")
+	remote_conf['filter'] = ' AND '.join(conditions)
+	return True
+
+#Признак изменения удаленной таблицы, который сдвигается при любой ее модификации
+def get_change_marker(method, columns_conf, remote_conf):
+	remote_name = remote_conf['prefix']+remote_conf['name']+remote_conf['postfix']
+	if method == 'rowscn':
+		answer = get_table_data(remote_conf['engine'], ['MAX(ORA_ROWSCN) AS SCN'], remote_name)
+	elif method == 'modifications':
+		#Счетчики DML попадают в словарь с задержкой, сбрасываем их туда сами (нужна привилегия ANALYZE ANY)
+		try:
+			with remote_conf['engine'].begin() as conn:
+				conn.execute(sa.text('BEGIN DBMS_STATS.FLUSH_DATABASE_MONITORING_INFO; END;'))
+		except BaseException as e:
+			logging.debug('Failed to flush the DML monitoring info: '+str(e))
+		#После сбора статистики счетчики обнуляются, поэтому в признак входит и время сбора
+		answer = get_table_data(remote_conf['engine'],
+								['t.last_analyzed AS ANALYZED', 'SUM(m.inserts) AS INSERTS', 'SUM(m.updates) AS UPDATES',
+								'SUM(m.deletes) AS DELETES', 'MAX(m.truncated) AS TRUNCATED', 'MAX(m.timestamp) AS MODIFIED'],
+								f"all_tables{remote_conf['postfix']} t LEFT JOIN all_tab_modifications{remote_conf['postfix']} m ON m.table_owner = t.owner AND m.table_name = t.table_name",
+								f"WHERE {owner_condition(remote_conf, 't.owner')} AND t.table_name = '{remote_conf['name']}' GROUP BY t.last_analyzed")
+		if answer == []:
+			logging.error(f"The table {remote_conf['name']} was not found in all_tables, use change_detection rowscn or checksum for views")
+			return None
+	elif method == 'checksum':
+		column_types = columns_conf['column_types']
+		columns = [column for column in columns_conf['local_columns']
+					if (column not in column_types) or (column_types[column]['DATA_TYPE'] not in lob_types)]
+		expr = key_hash_expr([remote_column_name(columns_conf, column) for column in columns], hash_column_types(columns_conf, columns, 'remote'))
+		answer = get_table_data(remote_conf['engine'], ['COUNT(*) AS CNT', f'SUM(ORA_HASH({expr})) AS HSUM'], remote_name)
+	else:
+		logging.error(f'Unknown change_detection {method} for the table '+remote_conf['name'])
+		return None
+	if answer == None:
+		return None
+	return [method] + list(answer[0].values())
+
+#Водяной знак и признак изменения сохраняем только после успешной синхронизации
+def commit_watermark(remote_conf, general_config, state_key):
+	values = {name : remote_conf[name] for name in ('watermark', 'change_marker') if remote_conf.get(name) != None}
+	if values == {}:
+		return True
+	if save_state(general_config, state_key, values) == None:
+		return False
+	return True
+
+#Синхронизация одной таблицы задачи
+def sync_table(sync, sync_conf, table, general_config, local_engine, remote_engine, one_db_query, show_only, metadata=None):
+	#Получаем имена таблиц с префиксами и без
+	local_table = { 'name' : list(table.keys())[0],
+						'prefix' : sync_conf['local_db']['scheme_name'],
+						'postfix' : sync_conf['local_db']['postfix'],
+						'engine' : local_engine}
+	remote_table = { 'name' : table[local_table['name']],
+						'prefix' : sync_conf['remote_db']['scheme_name'],
+						'postfix' : sync_conf['remote_db']['postfix'],
+						'engine' : remote_engine,
+						'filter' : ''}
+	state_key = f"{sync}.{local_table['name']}"
+	logging.info(f' Synchronizing table {local_table["name"]} ({sync})')
+	#Получаем информацию о столбцах таблиц
+	started = time.monotonic()
+	tables_columns = get_tables_columns(table, local_table, remote_table, metadata)
+	add_phase_time('metadata', started)
+	
+	if (tables_columns['remote_columns'] == None) or (tables_columns['remote_columns'] == []) or (tables_columns['local_columns'] == None):
+		logging.error(' An error occurred while synchronizing the table '+local_table['name'])
+		return False
+	#Кол-во строк нужно только для вывода сравнения
+	if (show_only == 'yes') and (tables_columns['local_columns'] != []):
+		tables_columns['lines_count'] = count_lines(local_table,
+													tables_columns['num_rows'],
+													get_option('use_num_rows', table, sync_conf, general_config, False))
+	
+	#Удаленная таблица не менялась с прошлой успешной синхронизации - пропускаем ее целиком
+	change_detection = get_option('change_detection', table, sync_conf, general_config, 'none')
+	if (change_detection != 'none') and (tables_columns['local_columns'] != []) and (show_only != 'yes'):
+		state = load_state(general_config, state_key)
+		if state == None:
+			return False
+		remote_table['change_marker'] = get_change_marker(change_detection, tables_columns, remote_table)
+		if remote_table['change_marker'] == None:
+			return False
+		if state.get('change_marker') == remote_table['change_marker']:
+			logging.info(f' The table {remote_table["name"]} has not changed since the last synchronization, skipped')
+			add_metric('unchanged')
+			return True
 	
-def sync_tables(yml_config, show_only):
+	#Выгружаем только строки выше сохраненного водяного знака
+	if ('incremental_column' in table) and (tables_columns['local_columns'] != []):
+		if sync_conf['sync_type'] in ('truncate', 'swap'):
+			logging.warning(f' incremental_column is ignored for sync_type {sync_conf["sync_type"]}, table '+local_table['name'])
+		else:
+			if set_watermark_filter(table['incremental_column'], tables_columns, remote_table, general_config, state_key) == None:
+				return False
+			if remote_table['watermark'] == remote_table['last_watermark']:
+				logging.info(f' No new lines in the table {remote_table["name"]} since {remote_table["last_watermark"]}')
+				return commit_watermark(remote_table, general_config, state_key)
+	
+	split_conf = {'chunks' : int(get_option('split', table, sync_conf, general_config, 1)),
+				'method' : get_option('split_method', table, sync_conf, general_config, 'hash'),
+				'column' : table.get('split_column')}
+	#Размеры пачек выборки и вставки подбираются под бюджет памяти
+	fetch_sizer = None
+	insert_sizer = None
+	memory_budget = get_option('memory_budget', table, sync_conf, general_config)
+	if memory_budget != None:
+		#Пачки выборки и вставки, очередь конвейера и очередь параллельной выгрузки
+		in_flight = 2
+		if get_option('pipeline', table, sync_conf, general_config, False):
+			in_flight += int(get_option('queue_depth', table, sync_conf, general_config, 4)) + int(get_option('writers', table, sync_conf, general_config, 1))
+		if split_conf['chunks'] > 1:
+			in_flight += split_conf['chunks'] * 3
+		array_size = int(get_option('array_size', table, sync_conf, general_config, 5000))
+		fetch_sizer = new_batch_sizer(memory_budget, tables_columns['local_columns'], tables_columns['column_types'], in_flight, array_size)
+		insert_sizer = new_batch_sizer(memory_budget, tables_columns['local_columns'], tables_columns['column_types'], in_flight, array_size)
+	#LOB до lob_inline_size приходят сразу в строке выборки, большие переливаются частями
+	lob_inline_size = get_option('lob_inline_size', table, sync_conf, general_config, 32768)
+	local_lobs = get_lob_conf(tables_columns['local_dictionary'], {}, lob_inline_size, table.get('diff_key', []))
+	remote_lobs = get_lob_conf(tables_columns['remote_dictionary'], tables_columns['map_columns'], lob_inline_size, table.get('diff_key', []))
+	
+	#Получаем данные из таблиц
+	if (tables_columns['local_columns'] != []):
+		local_table['data'] = get_big_table_data(local_table['engine'],
+									tables_columns['local_columns'],
+									local_table['prefix']+local_table['name']+local_table['postfix'],
+									'',
+									fetch_sizer,
+									local_lobs)
+	
+	if not one_db_query:
+		#Большую таблицу выгружаем параллельно несколькими сессиями
+		if split_conf['chunks'] > 1:
+			conditions = split_conditions(tables_columns, remote_table, split_conf)
+			if conditions == None:
+				logging.error(' Failed to split the table '+remote_table['name']+' for parallel extraction')
+				return False
+			remote_table['data'] = get_split_table_data(remote_table['engine'],
+									map_columns(tables_columns),
+									remote_table['prefix']+remote_table['name']+remote_table['postfix'],
+									remote_filter(remote_table, 'WHERE'),
+									conditions,
+									fetch_sizer,
+									remote_lobs)
+		else:
+			remote_table['data'] = get_big_table_data(remote_table['engine'],
+									map_columns(tables_columns),
+									remote_table['prefix']+remote_table['name']+remote_table['postfix'],
+									remote_filter(remote_table, 'WHERE'),
+									fetch_sizer,
+									remote_lobs)
+		
+	#Создаем таблицу, если она не существует	
+	if tables_columns['local_columns'] == []:
+		create_result = create_table(tables_columns, local_table, remote_table, one_db_query, show_only)
+		if show_only == 'yes':
+			logging.info('The specified table is not in the database. To create it, the following query will be used:')
+			logging.info(create_result)
+			return True
+		if create_result == None:
+			logging.error('An error occurred while trying to create the table '+local_table['name'])
+			return False
+		else:
+			tables_columns = get_tables_columns(table, local_table, remote_table)
+			local_lobs = get_lob_conf(tables_columns['local_dictionary'], {}, lob_inline_size, table.get('diff_key', []))
+			local_table['data'] = get_big_table_data(local_table['engine'],
+									tables_columns['local_columns'],
+									local_table['prefix']+local_table['name']+local_table['postfix'],
+									'',
+									fetch_sizer,
+									local_lobs)
+
+	if 'diff_key' in table:
+		tables_columns['diff_key'] = table['diff_key']
+	
+	#Загрузка с контрольными точками (только полная перезагрузка между разными БД)
+	checkpoint_conf = {'batches' : int(get_option('checkpoint', table, sync_conf, general_config, 0)),
+						'config' : general_config,
+						'state_key' : state_key,
+						'resume' : False}
+	if (checkpoint_conf['batches'] > 0) and ((sync_conf['sync_type'] != 'truncate') or one_db_query):
+		logging.warning(' checkpoint works only with sync_type truncate between two databases, table '+local_table['name'])
+		checkpoint_conf['batches'] = 0
+	if (checkpoint_conf['batches'] > 0) and (show_only != 'yes'):
+		state = load_state(general_config, state_key)
+		if state == None:
+			return False
+		checkpoint_conf['resume'] = state.get('checkpoint') != None
+	
+	#Скидываем бэкап
+	backup = None
+	#Продолжаем прерванную загрузку - в таблице только ее часть, такой бэкап не нужен
+	if checkpoint_conf['resume']:
+		logging.info(' The table '+local_table['name']+' is partially loaded, the backup is skipped')
+	elif (('backup' in sync_conf) and (sync_conf['backup'] == True) and (show_only != 'yes')):
+		backup = open_backup(local_table['name'],
+							general_config,
+							{'compress' : get_option('backup_compress', table, sync_conf, general_config, 'none'),
+							'level' : get_option('backup_level', table, sync_conf, general_config, 6),
+							'column_types' : tables_columns['column_types']})
+		local_table['data'] = backup_tee(local_table['data'], backup)
+		#Все строки локальной таблицы читает только сравнение через множество, бэкап пишется по ходу сравнения
+		#В остальных случаях таблицу читаем только ради бэкапа, и до того, как начнем ее менять
+		if not ((sync_conf['sync_type'] == 'diff') and (not one_db_query)
+				and (get_option('diff_method', table, sync_conf, general_config, 'set') == 'set')):
+			finish_backup(backup, local_table, sync_conf, general_config)
+			backup = None
+			local_table['data'] = get_big_table_data(local_table['engine'],
+													tables_columns['local_columns'],
+													local_table['prefix']+local_table['name']+local_table['postfix'],
+													'',
+													fetch_sizer,
+													local_lobs)
+
+	#Параметры вставки строк
+	load_conf = {'bulk_load' : get_option('bulk_load', table, sync_conf, general_config, False),
+				'append_values' : get_option('append_values', table, sync_conf, general_config, False),
+				'array_size' : int(get_option('array_size', table, sync_conf, general_config, 5000)),
+				'pipeline' : get_option('pipeline', table, sync_conf, general_config, False),
+				'queue_depth' : int(get_option('queue_depth', table, sync_conf, general_config, 4)),
+				'writers' : int(get_option('writers', table, sync_conf, general_config, 1)),
+				'column_types' : tables_columns['column_types'],
+				'sizer' : insert_sizer,
+				'max_errors' : get_option('max_errors', table, sync_conf, general_config),
+				'reject_path' : general_config.get('reject_path', './reject'),
+				'reject_name' : local_table['name'],
+				'fetch_sizer' : fetch_sizer,
+				'fetch_lobs' : remote_lobs}
+	
+	#Синхронизация изменений по ключу
+	if sync_conf['sync_type'] == 'merge':
+		started = time.monotonic()
+		merge_result = merge_sync(tables_columns, local_table, remote_table, one_db_query, show_only)
+		add_phase_time('merge', started)
+		if merge_result == None:
+			logging.error(' An error occurred while trying to merge changes into the table '+local_table['name'])
+			return False
+		if show_only == 'yes':
+			print('')
+			print(f'================== merge results fot {local_table["name"]} =========================')
+			print('')
+			print(f'Total lines: {tables_columns["lines_count"]}')
+			print(f'Only in remote lines: {merge_result["insert"]}')
+			print(f'Changed lines: {merge_result["update"]}')
+			print(f'Only in local lines: {merge_result["delete"]}')
+			print('')
+		else:
+			if merge_result != True:
+				logging.info(f' Table {local_table["name"]}: inserted {merge_result["insert"]}, updated {merge_result["update"]}, deleted {merge_result["delete"]} lines')
+			return commit_watermark(remote_table, general_config, state_key)
+		return True
+	
+	#Синхронизация через сравнение	
+	if (sync_conf['sync_type'] == 'diff') or (show_only == 'yes'):
+		#Сравнение полученных данных
+
+		diff_conf = {'method' : get_option('diff_method', table, sync_conf, general_config, 'set'),
+					'buckets' : int(get_option('checksum_buckets', table, sync_conf, general_config, 1024)),
+					'levels' : int(get_option('checksum_levels', table, sync_conf, general_config, 2)),
+					'lookup_keys' : int(get_option('fingerprint_lookup_keys', table, sync_conf, general_config, 100000)),
+					'key_index' : get_option('key_index', table, sync_conf, general_config, 'set'),
+					'key_index_verify' : get_option('key_index_verify', table, sync_conf, general_config, False)}
+		if diff_conf['method'] not in ('set', 'merge', 'checksum', 'fingerprint'):
+			logging.error(f' Unknown diff_method {diff_conf["method"]} for the table '+local_table['name'])
+			return False
+		started = time.monotonic()
+		comparison = compare_tables(remote_table,
+									local_table,
+									tables_columns,
+									one_db_query,
+									diff_conf)
+									
+		if (show_only == 'yes'):
+			print('')
+			print(f'================== diff results fot {local_table["name"]} =========================')
+			print('')
+			print(f'Total lines: {tables_columns["lines_count"]}')
+			if one_db_query:
+				only_remote = server_diff_count(tables_columns, local_table, remote_table)
+			else:
+				only_remote = 0
+				for row in comparison:
+					only_remote += 1
+			add_phase_time('diff', started)
+			print(f'Only in remote lines: {only_remote}')
+			print('')
+			return True
+		elif one_db_query:
+			#Обе таблицы видны из одной БД - вставляем недостающее одним запросом на сервере
+			insert_result = server_diff_insert(tables_columns, local_table, remote_table,
+												int(get_option('diff_chunks', table, sync_conf, general_config, 1)))
+		else:
+			insert_result = insert_table_data(local_table['engine'],
+											tables_columns['local_columns'],
+											local_table['prefix']+local_table['name']+local_table['postfix'],
+											comparison,
+											load_conf)
+		add_phase_time('diff', started)
+		if insert_result == None:
+			logging.error(' An error occurred while trying to insert data into the table '+local_table['name'])
+			return False
+		if backup != None:
+			finish_backup(backup, local_table, sync_conf, general_config)
+	#Синхронизация через промежуточную таблицу
+	if (sync_conf['sync_type'] == 'swap') and (show_only != 'yes'):
+		swap_conf = {'method' : get_option('swap_method', table, sync_conf, general_config, 'rename'),
+					'partition' : get_option('swap_partition', table, sync_conf, general_config)}
+		if (swap_conf['method'] == 'exchange') and (swap_conf['partition'] == None):
+			logging.error(' swap_partition is required for swap_method exchange, table '+local_table['name'])
+			return False
+		started = time.monotonic()
+		swap_result = swap_sync(tables_columns, local_table, remote_table, one_db_query, load_conf, swap_conf)
+		add_phase_time('swap', started)
+		if swap_result == None:
+			logging.error(' An error occurred while trying to reload the table '+local_table['name']+' through a staging table')
+			return False
+	#Синхронизация через полную очистку		
+	if sync_conf['sync_type'] == 'truncate':
+		started = time.monotonic()
+		if checkpoint_conf['batches'] > 0:
+			truncate_result = checkpoint_sync(tables_columns, local_table, remote_table, load_conf, checkpoint_conf)
+		else:
+			truncate_result = truncate_sync(tables_columns, local_table, remote_table, one_db_query, load_conf)
+		add_phase_time('truncate', started)
+		if truncate_result == None:
+			logging.error(' An error occurred while trying to reload the table '+local_table['name'])
+			return False
+	if show_only != 'yes':
+		return commit_watermark(remote_table, general_config, state_key)
+	return True
+
+#Фильтр логов: в параллельном режиме копим записи таблицы, чтобы вывести их одним блоком
+class TableLogFilter(logging.Filter):
+	def filter(self, record):
+		log_buffer = getattr(sync_context, 'log_buffer', None)
+		if log_buffer == None:
+			return True
+		#Запись проходит через каждый хендлер, сохраняем ее один раз
+		if (log_buffer == []) or (log_buffer[-1] is not record):
+			log_buffer.append(record)
+		return False
+
+#Экранирование значения метки Prometheus
+def prom_label(value):
+	return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+#Метрики таблиц в формате текстового файла Prometheus (node_exporter textfile collector)
+def prom_metrics(tables_metrics):
+	gauges = {'dbsync_table_success' : ('1 if the last sync of the table succeeded', lambda m: 1 if m['result'] else 0),
+			'dbsync_table_duration_seconds' : ('Duration of the table sync', lambda m: m['duration']),
+			'dbsync_table_rows_read' : ('Rows read from both databases', lambda m: m['rows_read']),
+			'dbsync_table_rows_written' : ('Rows written to the local table', lambda m: m['rows_written']),
+			'dbsync_table_rows_skipped' : ('Remote rows already present in the local table', lambda m: m['rows_skipped']),
+			'dbsync_table_batches' : ('Batches written to the local table', lambda m: m['batches']),
+			'dbsync_table_round_trips' : ('Database calls made by the script', lambda m: m['round_trips']),
+			'dbsync_table_rows_rejected' : ('Rows rejected by the database and written to the reject file', lambda m: m['rows_rejected']),
+			'dbsync_table_unchanged' : ('1 if the table was skipped because the remote table has not changed', lambda m: m['unchanged']),
+			'dbsync_table_lobs_streamed' : ('LOB values larger than lob_inline_size read in pieces', lambda m: m['lobs_streamed']),
+			'dbsync_table_peak_rss_bytes' : ('Peak RSS of the process after the table sync', lambda m: m['peak_rss_kb'] * 1024)}
+	lines = []
+	for name, (help_text, value) in gauges.items():
+		lines += [f'# HELP {name} {help_text}', f'# TYPE {name} gauge']
+		for metrics in tables_metrics:
+			lines.append(f'{name}{{sync="{prom_label(metrics["job"])}",table="{prom_label(metrics["table"])}"}} {value(metrics)}')
+	lines += ['# HELP dbsync_table_phase_seconds Time spent in a sync phase, phases running in several threads are summed',
+			'# TYPE dbsync_table_phase_seconds gauge']
+	for metrics in tables_metrics:
+		for phase, seconds in metrics['phases'].items():
+			lines.append(f'dbsync_table_phase_seconds{{sync="{prom_label(metrics["job"])}",table="{prom_label(metrics["table"])}",phase="{phase}"}} {seconds}')
+	return '\n'.join(lines)+'\n'
+
+#Запись метрик запуска: строка JSON на таблицу и, если задан, файл для Prometheus
+def write_metrics(general_config, tables_metrics):
+	if 'metrics_file' in general_config:
+		try:
+			with open(general_config['metrics_file'], 'a', encoding='utf-8') as f:
+				for metrics in tables_metrics:
+					f.write(json.dumps(metrics)+'\n')
+		except BaseException as e:
+			logging.error('Failed to write the metrics file '+general_config['metrics_file'])
+			logging.error(str(e))
+	if 'prometheus_file' in general_config:
+		filename = general_config['prometheus_file']
+		#Сборщик не должен увидеть файл недописанным
+		try:
+			with metrics_lock:
+				for metrics in tables_metrics:
+					prometheus_tables[(metrics['job'], metrics['table'])] = metrics
+				with open(filename+'.tmp', 'w', encoding='utf-8') as f:
+					f.write(prom_metrics(list(prometheus_tables.values())))
+				os.replace(filename+'.tmp', filename)
+		except BaseException as e:
+			logging.error('Failed to write the metrics file '+filename)
+			logging.error(str(e))
+
+#Выполнение синхронизации таблицы в отдельном потоке с учетом лимитов сессий
+def run_table_task(task, parallel):
+	if parallel:
+		sync_context.log_buffer = []
+	for semaphore in task['semaphores']:
+		semaphore.acquire()
+	#Лимиты подключений каждой стороны для дополнительных сессий таблицы
+	sync_context.session_limits = task['session_limits']
+	#Ожидание свободных сессий в метрики не входит
+	sync_context.metrics = new_metrics(task['sync'], list(task['table'].keys())[0])
+	started = time.monotonic()
+	try:
+		result = sync_table(task['sync'], task['sync_conf'], task['table'], task['general_config'],
+							task['local_engine'], task['remote_engine'], task['one_db_query'], task['show_only'], task['metadata'])
+	except BaseException as e:
+		logging.error(' An error occurred while synchronizing the table '+list(task['table'].keys())[0])
+		logging.error(str(e))
+		result = False
+	finally:
+		for semaphore in reversed(task['semaphores']):
+			semaphore.release()
+		sync_context.session_limits = None
+		log_buffer = getattr(sync_context, 'log_buffer', None)
+		sync_context.log_buffer = None
+		metrics = sync_context.metrics
+		sync_context.metrics = None
+	metrics['result'] = result
+	metrics['duration'] = round(time.monotonic() - started, 3)
+	metrics['phases'] = {phase : round(seconds, 3) for phase, seconds in metrics['phases'].items()}
+	metrics['peak_rss_kb'] = peak_rss_kb()
+	return result, log_buffer or [], metrics
+
+#Имена подключений, сессии которых занимает задача (dblink открывает сессию в avail_from)
+def get_task_connections(sync_names, conn_config):
+	names = set()
+	for name in sync_names:
+		names.add(name)
+		if ('avail_from' in conn_config[name]):
+			names.add(conn_config[name]['avail_from'])
+	return sorted(names)
+
+#Ограничения на кол-во одновременных сессий к подключению
+def get_connection_limits(conn_config):
+	connection_limits = {}
+	for name in conn_config:
+		if 'max_sessions' in conn_config[name]:
+			connection_limits[name] = threading.BoundedSemaphore(int(conn_config[name]['max_sessions']))
+	return connection_limits
+
+#Синхронизация заданий jobs (по умолчанию всех), лимиты сессий демон передает общие для всех запусков
+def sync_tables(yml_config, show_only, jobs=None, connection_limits=None):
 	
 	general_config = yml_config['General']
 	conn_config = yml_config['Connections']
 	
-	config = yml_config['Sync']
+	config = {}
+	pool_conf = get_pool_conf(general_config)
+	
+	if connection_limits == None:
+		connection_limits = get_connection_limits(conn_config)
 	
-	for sync in config:
-		config[sync] = replace_connects(config[sync], conn_config)
+	tasks = []
+	failed = []
+	for sync in yml_config['Sync']:
+		if (jobs != None) and (sync not in jobs):
+			continue
+		task_connections = get_task_connections([yml_config['Sync'][sync]['local_db'], yml_config['Sync'][sync]['remote_db']], conn_config)
+		session_limits = {side : [connection_limits[name] for name in get_task_connections([yml_config['Sync'][sync][side+'_db']], conn_config) if name in connection_limits]
+						for side in ('local', 'remote')}
+		config[sync] = replace_connects(yml_config['Sync'][sync], conn_config)
 		#Пробуем подключиться к базам
-		local_engine = get_db_connection(config[sync]['local_db'])
-		if (get_db_connection(config[sync]['remote_db'], True) == get_db_connection(config[sync]['local_db'], True)):
-			remote_engine = local_engine
-			one_db_query = True
-		else:	
-			remote_engine = get_db_connection(config[sync]['remote_db'])
-			one_db_query = False
-		
+		local_engine = get_db_connection(config[sync]['local_db'], pool_conf)
+		remote_engine = get_db_connection(config[sync]['remote_db'], pool_conf)
 		if (remote_engine == None) or (local_engine == None):
 			logging.critical(' Failed to establish a connection to one of the databases for syncing '+sync)
+			failed += [list(table.keys())[0] for table in config[sync]['tables']]
 			continue
+		#Один движок - обе таблицы видны из одной БД (dblink)
+		one_db_query = remote_engine is local_engine
+		#Словарь данных читаем разом для всех таблиц задания
+		metadata = get_job_metadata(config[sync],
+									{'engine' : local_engine,
+									'prefix' : config[sync]['local_db']['scheme_name'],
+									'postfix' : config[sync]['local_db']['postfix']},
+									{'engine' : remote_engine,
+									'prefix' : config[sync]['remote_db']['scheme_name'],
+									'postfix' : config[sync]['remote_db']['postfix']},
+									general_config,
+									show_only)
 
 		for table in config[sync]['tables']:
-			#Получаем имена таблиц с префиксами и без
-			local_table = { 'name' : list(table.keys())[0],
-								'prefix' : config[sync]['local_db']['scheme_name'],
-								'postfix' : config[sync]['local_db']['postfix'],
-								'engine' : local_engine}
-			remote_table = { 'name' : table[local_table['name']],
-								'prefix' : config[sync]['remote_db']['scheme_name'],
-								'postfix' : config[sync]['remote_db']['postfix'],
-								'engine' : remote_engine}
-			#Получаем информацию о столбцах таблиц
-			tables_columns = get_tables_columns(table, local_table, remote_table)
-			
-			if (tables_columns['remote_columns'] == None) or (tables_columns['remote_columns'] == []) or (tables_columns['local_columns'] == None):
-				logging.error(' An error occurred while synchronizing the table '+local_table['name'])
+			tasks.append({'sync' : sync,
+						'sync_conf' : config[sync],
+						'table' : table,
+						'general_config' : general_config,
+						'local_engine' : local_engine,
+						'remote_engine' : remote_engine,
+						'one_db_query' : one_db_query,
+						'show_only' : show_only,
+						'metadata' : metadata,
+						'semaphores' : [connection_limits[name] for name in task_connections if name in connection_limits],
+						'session_limits' : session_limits})
+	
+	#Вывод сравнения идет в stdout, поэтому в режиме show-only работаем последовательно
+	workers = int(general_config.get('workers', 1))
+	parallel = (workers > 1) and (show_only != 'yes') and (len(tasks) > 1)
+	
+	results = []
+	tables_metrics = []
+	if parallel:
+		with ThreadPoolExecutor(max_workers=workers) as executor:
+			futures = [executor.submit(run_table_task, task, True) for task in tasks]
+			#Логи таблиц выводим в порядке конфига по мере завершения
+			for future in futures:
+				result, log_buffer, metrics = future.result()
+				for record in log_buffer:
+					logging.getLogger().handle(record)
+				results.append(result)
+				tables_metrics.append(metrics)
+	else:
+		for task in tasks:
+			result, log_buffer, metrics = run_table_task(task, False)
+			results.append(result)
+			tables_metrics.append(metrics)
+	write_metrics(general_config, tables_metrics)
+	
+	for task, result in zip(tasks, results):
+		if not result:
+			failed.append(list(task['table'].keys())[0])
+	
+	logging.info(f' Synchronized tables: {results.count(True)}, failed: {len(failed)}')
+	if failed:
+		logging.error(' Failed tables: '+', '.join(failed))
+	return failed == []
+
+#Разбор поля cron: *, списки, диапазоны и шаг
+def cron_field(field, low, high):
+	values = set()
+	for part in field.split(','):
+		step = 1
+		if '/' in part:
+			part, step = part.split('/')
+			step = int(step)
+		if part == '*':
+			start, end = low, high
+		elif '-' in part:
+			start, end = [int(value) for value in part.split('-')]
+		else:
+			start = int(part)
+			end = high if step > 1 else start
+		if (start < low) or (end > high) or (start > end) or (step < 1):
+			raise ValueError(f'Invalid cron field {field}')
+		values.update(range(start, end + 1, step))
+	return values
+
+#Выражение cron из пяти полей: минута, час, день месяца, месяц, день недели (0 и 7 - воскресенье)
+def parse_cron(expr):
+	fields = str(expr).split()
+	if len(fields) != 5:
+		raise ValueError(f'Invalid cron expression {expr}')
+	cron = {'minutes' : cron_field(fields[0], 0, 59),
+			'hours' : cron_field(fields[1], 0, 23),
+			'days' : cron_field(fields[2], 1, 31),
+			'months' : cron_field(fields[3], 1, 12),
+			'weekdays' : {day % 7 for day in cron_field(fields[4], 0, 7)},
+			'any_day' : fields[2] == '*',
+			'any_weekday' : fields[4] == '*'}
+	return cron
+
+#Подходит ли день под cron: если заданы и день месяца, и день недели, достаточно одного из них
+def cron_day_match(cron, moment):
+	day_match = moment.day in cron['days']
+	weekday_match = (moment.weekday() + 1) % 7 in cron['weekdays']
+	if cron['any_day'] or cron['any_weekday']:
+		return day_match and weekday_match
+	return day_match or weekday_match
+
+#Ближайшая минута после after, подходящая под cron
+def next_cron_time(cron, after):
+	moment = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+	#Несуществующая дата (31 февраля) не найдется никогда, ищем в пределах нескольких лет
+	deadline = moment + timedelta(days=366 * 5)
+	while moment < deadline:
+		if moment.month not in cron['months']:
+			moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+		elif not cron_day_match(cron, moment):
+			moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+		elif moment.hour not in cron['hours']:
+			moment = moment.replace(minute=0) + timedelta(hours=1)
+		elif moment.minute not in cron['minutes']:
+			moment += timedelta(minutes=1)
+		else:
+			return moment
+	raise ValueError('The cron expression never matches')
+
+#Время следующего запуска задания: по cron или через interval секунд
+def next_run_time(sync_conf, after):
+	if 'cron' in sync_conf:
+		return next_cron_time(parse_cron(sync_conf['cron']), after)
+	return after + timedelta(seconds=float(sync_conf['interval']))
+
+#Расписание демона: задания без interval и cron не запускаются
+def build_schedule(yml_config):
+	schedule = {}
+	now = datetime.now()
+	for sync, sync_conf in yml_config['Sync'].items():
+		if ('cron' not in sync_conf) and ('interval' not in sync_conf):
+			logging.warning(f' The job {sync} has neither interval nor cron and is not scheduled')
+			continue
+		try:
+			#Задания с интервалом запускаем сразу, с cron - в ближайшее подходящее время
+			schedule[sync] = now if 'cron' not in sync_conf else next_run_time(sync_conf, now)
+		except (ValueError, TypeError) as e:
+			logging.error(f' Invalid schedule of the job {sync}: {e}')
+	return schedule
+
+def load_config(config_file, workers=None):
+	with open(config_file) as yml:
+		yml_config = yaml.load(yml, Loader=SafeLoader)
+	if workers != None:
+		yml_config['General']['workers'] = workers
+	#Между запусками метаданные берем из кэша, пока не изменилась структура таблиц
+	yml_config['General'].setdefault('metadata_cache', True)
+	return yml_config
+
+#Режим демона: конфиг читается один раз (и по SIGHUP), задания запускаются по своему расписанию
+#Пулы сессий живут между запусками, задание пропускается, если прошлый его запуск еще идет
+def run_daemon(config_file, workers=None):
+	events = {'reload' : False, 'stop' : False}
+	wake = threading.Event()
+	
+	def on_signal(signum, frame):
+		if signum == getattr(signal, 'SIGHUP', None):
+			events['reload'] = True
+		else:
+			events['stop'] = True
+		wake.set()
+	
+	for name in ('SIGHUP', 'SIGTERM', 'SIGINT'):
+		if hasattr(signal, name):
+			signal.signal(getattr(signal, name), on_signal)
+	
+	yml_config = load_config(config_file, workers)
+	connection_limits = get_connection_limits(yml_config['Connections'])
+	schedule = build_schedule(yml_config)
+	running = {}
+	logging.info(f' Daemon started, scheduled jobs: {", ".join(schedule) or "none"}')
+	while not events['stop']:
+		if events['reload']:
+			events['reload'] = False
+			try:
+				yml_config = load_config(config_file, workers)
+				connection_limits = get_connection_limits(yml_config['Connections'])
+				schedule = build_schedule(yml_config)
+				logging.info(f' Config reloaded, scheduled jobs: {", ".join(schedule) or "none"}')
+			except BaseException as e:
+				logging.error(' Failed to reload the config, the previous one is used')
+				logging.error(str(e))
+		now = datetime.now()
+		for sync in schedule:
+			if schedule[sync] > now:
 				continue
-			
-			#Получаем данные из таблиц
-			if (tables_columns['local_columns'] != []):
-				local_table['data'] = get_big_table_data(local_table['engine'],
-											tables_columns['local_columns'],
-											local_table['prefix']+local_table['name']+local_table['postfix'])
-			
-			if not one_db_query:
-				remote_table['data'] = get_big_table_data(remote_table['engine'],
-											map_columns(tables_columns),
-											remote_table['prefix']+remote_table['name']+remote_table['postfix'])
-				
-			#Создаем таблицу, если она не существует	
-			if tables_columns['local_columns'] == []:
-				create_result = create_table(tables_columns, local_table, remote_table, one_db_query, show_only)
-				if show_only == 'yes':
-					logging.info('The specified table is not in the database. To create it, the following query will be used:')
-					logging.info(create_result)
-					continue
-				if create_result == None:
-					logging.error('An error occurred while trying to create the table '+local_table['name'])
-					continue
-				else:
-					tables_columns = get_tables_columns(table, local_table, remote_table)
-					local_table['data'] = get_big_table_data(local_table['engine'],
-											tables_columns['local_columns'],
-											local_table['prefix']+local_table['name']+local_table['postfix'])
-
-			#Скидываем бэкап
-			if (('backup' in config[sync]) and (config[sync]['backup'] == True) and (show_only != 'yes')):
-				backup_result = make_csv(local_table['data'], local_table['name'], general_config)
-				local_table['data'] = get_big_table_data(local_table['engine'],
-														tables_columns['local_columns'],
-														local_table['prefix']+local_table['name']+local_table['postfix'])
-				if ('rotate' in config[sync]):
-					delete_old_backups(local_table['name'], config[sync]['rotate'], general_config)
-
-			#Синхронизация через сравнение	
-			if (config[sync]['sync_type'] == 'diff') or (show_only == 'yes'):
-				#Сравнение полученных данных
-				if 'diff_key' in table:
-					tables_columns['diff_key'] = table['diff_key']
-		
-				comparison = compare_tables(remote_table,
-											local_table,
-											tables_columns,
-											one_db_query)
-											
-				if (show_only == 'yes'):
-					print('')
-					print(f'================== diff results fot {local_table["name"]} =========================')
-					print('')
-					print(f'Total lines: {tables_columns["lines_count"]}')
-					tmp_list = []
-					for row in comparison:
-						tmp_list.append(row)
-					print(f'Only in remote lines: {len(tmp_list)}')
-					print('')
-					continue
-				else:
-					insert_result = insert_table_data(local_table['engine'], tables_columns['local_columns'], local_table['name'], comparison)
-					if insert_result == None:
-						logging.error(' An error occurred while trying to insert data into the table '+local_table['name'])
-			#Синхронизация через полную очистку		
-			if config[sync]['sync_type'] == 'truncate':
-				truncate_result = truncate_sync(tables_columns, local_table, remote_table, one_db_query)
+			if (sync in running) and running[sync].is_alive():
+				logging.warning(f' The previous run of the job {sync} is still in progress, this run is skipped')
+			else:
+				running[sync] = threading.Thread(target=sync_tables,
+												args=(yml_config, 'no', [sync], connection_limits),
+												name=sync,
+												daemon=True)
+				running[sync].start()
+			schedule[sync] = next_run_time(yml_config['Sync'][sync], now)
+			#Пропущенные запуски не наверстываем
+			while schedule[sync] <= now:
+				schedule[sync] = next_run_time(yml_config['Sync'][sync], schedule[sync])
+		timeout = 60
+		if schedule:
+			timeout = min(timeout, max(0, (min(schedule.values()) - datetime.now()).total_seconds()))
+		wake.wait(timeout)
+		wake.clear()
+	logging.info(' Stopping the daemon, waiting for running jobs')
+	for thread in running.values():
+		thread.join()
+	return True
 
 def get_log_level(level_str):
 	try:
@@ -569,6 +3098,10 @@ def setup_logging(config, cmd_arg):
 
 	# Всегда лог в stdout
 	handlers.append(logging.StreamHandler())
+	
+	# В параллельном режиме логи таблицы выводятся одним блоком
+	for handler in handlers:
+		handler.addFilter(TableLogFilter())
 
 	logging.basicConfig(
 		level=log_level,
@@ -592,9 +3125,13 @@ if __name__ == '__main__':
 	cmd_parser.add_argument('-o','--output', dest='local_table', help='local table')
 	cmd_parser.add_argument('-l','--local-conn', dest='local_db_name', default='pl_db', help='local db')
 	cmd_parser.add_argument('-r','--remote-conn', dest='remote_db_name', default='prod', help='remote db')
-	cmd_parser.add_argument('-m','--method-sync', dest='sync_type', default='truncate', choices=['truncate', 'diff'], help='sync type')
+	cmd_parser.add_argument('-m','--method-sync', dest='sync_type', default='truncate', choices=['truncate', 'diff', 'merge', 'swap'], help='sync type')
 	cmd_parser.add_argument('-s','--show-only', dest='show_only', default='no', choices=['yes', 'no'], help='only show tables diffs')
 	cmd_parser.add_argument('-ll','--log-level', dest='log_level', default='-', choices=['CRITICAL', 'ERROR', 'WARNING', 'INFO', 'DEBUG'], help='log level')
+	cmd_parser.add_argument('-w','--workers', dest='workers', type=int, help='number of tables synchronized in parallel')
+	cmd_parser.add_argument('--restore', dest='restore_table', help='restore the local table from a backup')
+	cmd_parser.add_argument('-d', '--daemon', action='store_true', help='run jobs on their interval/cron schedule until stopped, SIGHUP reloads the config')
+	cmd_parser.add_argument('--at', dest='restore_at', help='restore the last backup made not later than this time (YYYY-MM-DD HH:MM:SS)')
 	
 	cmd_args = cmd_parser.parse_args()
 	
@@ -614,6 +3151,29 @@ if __name__ == '__main__':
 									'backup': True, 
 									'rotate': 1, 
 									'tables': [{ cmd_args.local_table : cmd_args.remote_table }]}}
-	sync_tables(yml_config, cmd_args.show_only)
+	if cmd_args.daemon:
+		sync_result = run_daemon(cmd_args.config, cmd_args.workers)
+	elif cmd_args.restore_table != None:
+		restore_at = None
+		if cmd_args.restore_at != None:
+			for time_format in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d_%H%M%S", "%Y-%m-%d %H:%M", "%Y-%m-%d"):
+				try:
+					restore_at = datetime.strptime(cmd_args.restore_at, time_format)
+					break
+				except ValueError:
+					pass
+			if restore_at == None:
+				cmd_parser.error('invalid --at value: '+cmd_args.restore_at)
+		sync_result = restore_table(yml_config,
+									cmd_args.restore_table,
+									restore_at,
+									cmd_args.local_db_name,
+									cmd_args.workers or int(yml_config['General'].get('restore_workers', 4)))
+	else:
+		if cmd_args.workers != None:
+			yml_config['General']['workers'] = cmd_args.workers
+		sync_result = sync_tables(yml_config, cmd_args.show_only)
 	
 	logging.info(f'================== The script execution time was: {(datetime.now() - start_time)} =========================')
+	if not sync_result:
+		sys.exit(1)